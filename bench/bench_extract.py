@@ -0,0 +1,89 @@
+"""
+Compares the paragraph extractors on saved story pages.
+
+    python -m bench.bench_extract [-n <repeat>] [<page.html> ...]
+
+Without page arguments the pages in bench/pages are used.  Each available extractor parses every
+page `repeat` times; throughput and the speedup over the original BeautifulSoup path are printed,
+and the extracted text is checked against the reference.
+"""
+import getopt
+import html
+import os
+import re
+import sys
+import time
+from pathlib import Path
+
+from litero.extract import EXTRACTORS, SoupExtractor
+
+PAGES_DIR = Path(__file__).parent / "pages"
+
+
+def load_pages(paths):
+    if not paths:
+        paths = sorted(PAGES_DIR.glob("*.html"))
+    return [ (os.path.basename(p), Path(p).read_text(encoding='utf-8')) for p in paths ]
+
+def normalized(paras):
+    return [ re.sub(r"\s+", " ", html.unescape(p.text)).strip() for p in paras ]
+
+def time_extractor(extractor, pages, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        for _, body in pages:
+            extractor.extract(body)
+    return time.perf_counter() - start
+
+def usage(app):
+        print(f"Usage: python -m bench.bench_extract [-n <repeat>] [<page.html> ...]")
+        sys.exit(1)
+
+def main(argv):
+    repeat = 50
+    try:
+        opts, args = getopt.getopt(argv[1:], "n:")
+        opts = dict(opts)
+        if '-n' in opts: repeat = int(opts['-n'])
+    except:
+        usage(argv[0])
+
+    pages = load_pages(args)
+    if not pages:
+        usage(argv[0])
+    size = sum(len(body) for _, body in pages)
+    print(f"{len(pages)} pages, {size/1024:.0f} KiB, {repeat} rounds")
+
+    extractors = []
+    for name, cls in EXTRACTORS.items():
+        try:
+            extractors.append(cls())
+        except RuntimeError as ex:
+            print(f"{name:8s} skipped: {ex}")
+
+    reference = None
+    if any(isinstance(e, SoupExtractor) for e in extractors):
+        reference = { name: normalized(SoupExtractor().extract(body)) for name, body in pages }
+
+    baseline = None
+    results = []
+    for extractor in extractors:
+        elapsed = time_extractor(extractor, pages, repeat)
+        if isinstance(extractor, SoupExtractor):
+            baseline = elapsed
+        results.append((extractor, elapsed))
+
+    for extractor, elapsed in results:
+        rate = len(pages) * repeat / elapsed
+        mbps = size * repeat / elapsed / 1e6
+        line = f"{extractor.name:8s} {elapsed:7.3f}s {rate:8.1f} pages/s {mbps:6.2f} MB/s"
+        if baseline:
+            line += f"  x{baseline/elapsed:.2f} vs soup"
+        if reference is not None:
+            same = all(normalized(extractor.extract(body)) == reference[name] for name, body in pages)
+            line += "  text matches" if same else "  TEXT DIFFERS"
+        print(line)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,230 @@
+"""
+Offline benchmarks of each stage of the pipeline, from fetching a story to encoding its audio.
+
+    python -m bench.bench_suite [-s <scale>] [-b <backend>] [-t <tolerance>] [-w] [<stage> ...]
+
+Stages:
+    fetch      Litero.fetch_story_content over every page of a story served by a local HTTP server
+    fetch_all  Litero.fetch_chapter_pages, the concurrent fetch of a whole story
+    pack       pack_parts packing the story's paragraphs into Polly parts
+    chunk      tts.html_to_tts_chunks over a synthetic book
+    synth      tts.synthesize over the book's chunks with the chosen backend
+    encode     tts.save_mp4 encoding the book's audio (MB/s of 16 bit PCM in)
+
+The corpus is generated (see bench.corpus) plus the saved pages in bench/pages; scale multiplies
+its size.  The backend of synth is 'stub' (a tone of plausible length for the text, so only
+the code around Kokoro is measured), 'kokoro' or 'kokoro-int8'.  Each stage runs in a fresh
+process so that its peak RSS is its own.  Stages whose dependencies are missing are skipped.
+
+Results are compared with bench/baseline.json when it exists: a stage slower, or bigger, than
+its baseline by more than tolerance (default 0.25) is a regression, and the exit status is 1.
+-w writes the results as the new baseline; record it on the machine the comparisons run on.
+"""
+import contextlib
+import getopt
+import io
+import json
+import multiprocessing
+import os
+import resource
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from bench import corpus
+
+BASELINE = Path(__file__).parent / "baseline.json"
+STAGES = [ "fetch", "fetch_all", "pack", "chunk", "synth", "encode" ]
+
+
+class Skipped(Exception):
+    """A stage cannot run here, e.g. because a program it needs is missing."""
+
+
+def peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 / 1024 if sys.platform == "darwin" else rss / 1024
+
+def story_size(scale):
+    return dict(chapters=3 * scale, pages=3, paragraphs=40)
+
+def bench_story(server, scale):
+    from litero.story import Story
+    chapters = [ server.url(f"bench-story-ch-{c:02d}") for c in range(1, story_size(scale)['chapters'] + 1) ]
+    return Story({ "title": "Bench Story", "chapters": chapters })
+
+def stage_fetch(scale, backend, rounds=10):
+    from litero.litero import Litero
+    pages = corpus.story_pages(**story_size(scale))
+    pages.update(corpus.saved_pages())
+    with corpus.CorpusServer(pages) as server:
+        lit = Litero(bench_story(server, scale), max_workers=1)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            for slug, page in pages:
+                for _ in lit.fetch_story_content(server.url(slug), page):
+                    pass
+        elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, items=len(pages) * rounds, unit="pages", bytes=sum(len(b) for b in pages.values()) * rounds)
+
+def stage_fetch_all(scale, backend, rounds=10):
+    from litero.litero import Litero
+    pages = corpus.story_pages(**story_size(scale))
+    with corpus.CorpusServer(pages) as server:
+        start = time.perf_counter()
+        for _ in range(rounds):
+            # a new story each round, so the page counts are discovered again
+            lit = Litero(bench_story(server, scale))
+            fetched = list(lit.fetch_chapter_pages(lit.story))
+        elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, items=len(fetched) * rounds, unit="pages", bytes=sum(len(b) for b in pages.values()) * rounds)
+
+def stage_pack(scale, backend):
+    from litero.packer import pack_parts
+    from litero.extract import get_extractor
+    extractor = get_extractor()
+    paragraphs = [ p.text for body in corpus.story_pages(**story_size(scale * 10)).values() for p in extractor.extract(body) ]
+    chars = sum(len(p) for p in paragraphs)
+    repeat = 20
+    start = time.perf_counter()
+    for _ in range(repeat):
+        parts = list(pack_parts(paragraphs))
+    elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, items=len(parts) * repeat, unit="parts", bytes=chars * repeat)
+
+def stage_chunk(scale, backend):
+    import tts
+    book = corpus.book_html(**story_size(scale * 10))
+    start = time.perf_counter()
+    chunks = tts.html_to_tts_chunks(book)
+    elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, items=len(chunks), unit="chunks", bytes=len(book))
+
+class StubPipeline:
+    """Stands in for KPipeline: a quiet tone as long as the text would take to say."""
+    def __init__(self, chars_per_second=15.0):
+        self.chars_per_second = chars_per_second
+
+    def __call__(self, text, voice, speed):
+        import torch
+        import tts
+        samples = int(len(text) / self.chars_per_second / speed * tts.SAMPLE_RATE)
+        t = torch.arange(samples, dtype=torch.float32) / tts.SAMPLE_RATE
+        yield text, None, 0.1 * torch.sin(2 * torch.pi * 220 * t)
+
+def make_backend(backend):
+    import tts
+    if backend == "stub":
+        return StubPipeline()
+    return tts.load_pipeline('cpu', quantize=(backend == "kokoro-int8"))
+
+def book_chunks(scale, backend):
+    import tts
+    # a real model reads a few paragraphs; the stub reads a chapter per unit of scale
+    size = dict(chapters=scale, pages=3, paragraphs=40) if backend == "stub" else dict(chapters=1, pages=1, paragraphs=5 * scale)
+    return list(tts.pack_chunks(tts.iter_tts_chunks(corpus.book_html(**size))))
+
+def stage_synth(scale, backend):
+    import tts
+    chunks = book_chunks(scale, backend)
+    pipeline = make_backend(backend)
+    start = time.perf_counter()
+    waveform = tts.synthesize(chunks, 'af_bella', 1.0, 'cpu', pipeline=pipeline)
+    elapsed = time.perf_counter() - start
+    return dict(seconds=elapsed, items=len(chunks), unit="chunks", bytes=sum(len(c) for c in chunks),
+                audio_seconds=waveform.numel() / tts.SAMPLE_RATE)
+
+def stage_encode(scale, backend):
+    import shutil
+    import tts
+    if shutil.which('ffmpeg') is None:
+        raise Skipped("ffmpeg is not installed")
+    waveform = tts.synthesize(book_chunks(scale, "stub"), 'af_bella', 1.0, 'cpu', pipeline=StubPipeline())
+    with tempfile.TemporaryDirectory() as tmp:
+        start = time.perf_counter()
+        tts.save_mp4(waveform, Path(tmp) / "bench.m4b")
+        elapsed = time.perf_counter() - start
+        size = os.path.getsize(Path(tmp) / "bench.m4b")
+    return dict(seconds=elapsed, items=1, unit="files", bytes=waveform.numel() * 2, audio_seconds=waveform.numel() / tts.SAMPLE_RATE,
+                output_bytes=size)
+
+
+def run_stage(name, scale, backend):
+    """Runs a stage in this process; returns its results, or {'skipped': reason}."""
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = globals()["stage_" + name](scale, backend)
+    except (ImportError, Skipped) as ex:
+        return dict(skipped=str(ex))
+    result['rss_mb'] = peak_rss_mb()
+    return result
+
+def report(name, result, base, tolerance):
+    if 'skipped' in result:
+        return f"{name:10s} skipped: {result['skipped']}", False
+    seconds = result['seconds']
+    line = f"{name:10s} {seconds:8.3f}s {result['items']/seconds:10.1f} {result['unit']}/s {result['bytes']/seconds/1e6:8.2f} MB/s"
+    if 'audio_seconds' in result:
+        line += f"  RTF {seconds/result['audio_seconds']:.4f}"
+    line += f"  RSS {result['rss_mb']:7.1f} MB"
+    regressed = False
+    if base and 'seconds' in base:
+        dt = seconds / base['seconds'] - 1
+        dm = result['rss_mb'] / base['rss_mb'] - 1
+        regressed = dt > tolerance or dm > tolerance
+        line += f"  time {dt:+.0%} rss {dm:+.0%}" + ("  REGRESSION" if regressed else "")
+    return line, regressed
+
+def usage(app):
+        print(f"Usage: python -m bench.bench_suite [-s <scale>] [-b stub|kokoro|kokoro-int8] [-t <tolerance>] [-w] [<stage> ...]")
+        sys.exit(1)
+
+def main(argv):
+    scale = 1
+    backend = "stub"
+    tolerance = 0.25
+    write = False
+    try:
+        opts, args = getopt.getopt(argv[1:], "s:b:t:w")
+        opts = dict(opts)
+        if '-s' in opts: scale = int(opts['-s'])
+        if '-b' in opts: backend = opts['-b']
+        if '-t' in opts: tolerance = float(opts['-t'])
+        write = '-w' in opts
+    except:
+        usage(argv[0])
+    stages = args or STAGES
+    if backend not in ("stub", "kokoro", "kokoro-int8") or any(s not in STAGES for s in stages):
+        usage(argv[0])
+
+    baseline = {}
+    if BASELINE.exists():
+        baseline = json.loads(BASELINE.read_text())
+        if baseline.get('scale') != scale or baseline.get('backend') != backend:
+            print(f"baseline is for scale {baseline.get('scale')} backend {baseline.get('backend')}; not compared")
+            baseline = {}
+    print(f"scale {scale}, backend {backend}")
+
+    results = {}
+    regressions = []
+    context = multiprocessing.get_context("spawn")
+    for name in stages:
+        # a fresh process per stage, so that the peak RSS belongs to the stage
+        with context.Pool(1) as pool:
+            results[name] = pool.apply(run_stage, (name, scale, backend))
+        line, regressed = report(name, results[name], baseline.get('stages', {}).get(name), tolerance)
+        print(line)
+        if regressed:
+            regressions.append(name)
+
+    if write:
+        BASELINE.write_text(json.dumps(dict(scale=scale, backend=backend, stages=results), indent=1) + "\n")
+        print(f"baseline written to {BASELINE}")
+    if regressions:
+        print(f"regressions: {' '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
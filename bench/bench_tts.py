@@ -0,0 +1,77 @@
+"""
+Measures the real-time factor of Kokoro synthesis with and without sentence packing.
+
+    python -m bench.bench_tts [-s <sentences>] [-m <max-chars>] [-d <device>] [<page.html>]
+
+The first `sentences` sentences of the page (bench/pages/the-quiet-river.html by default) are
+read by one Kokoro pipeline once with one sentence per call and once packed into batches of up
+to `max-chars` characters.  Break markers are skipped, so only speech is timed.  The real-time
+factor is the synthesis time divided by the length of the audio produced; lower is faster.
+Needs torch and kokoro.
+"""
+import getopt
+import sys
+import time
+from pathlib import Path
+
+from kokoro import KPipeline
+
+import tts
+
+DEFAULT_PAGE = Path(__file__).parent / "pages" / "the-quiet-river.html"
+
+
+def first_sentences(chunks, count):
+    """Returns the chunks up to and including the count-th sentence."""
+    result = []
+    for chunk in chunks:
+        result.append(chunk)
+        if not chunk.startswith("[break="):
+            count -= 1
+            if count == 0:
+                break
+    return result
+
+def run(pipeline, chunks, label):
+    texts = [ c.replace("[cinematic]", "").strip() for c in chunks if not c.startswith("[break=") ]
+    samples = 0
+    start = time.perf_counter()
+    for text in texts:
+        for _, _, audio in pipeline(text, voice='af_bella', speed=1.0):
+            if audio is not None:
+                samples += audio.numel()
+    elapsed = time.perf_counter() - start
+    seconds = samples / 24000
+    calls = len(texts)
+    print(f"{label:12s} {calls:5d} calls {seconds:7.1f}s audio {elapsed:7.1f}s  RTF {elapsed/seconds:.3f}")
+    return elapsed / seconds
+
+def usage(app):
+        print(f"Usage: python -m bench.bench_tts [-s <sentences>] [-m <max-chars>] [-d <device>] [<page.html>]")
+        sys.exit(1)
+
+def main(argv):
+    device = None
+    sentences = 60
+    max_chars = 400
+    try:
+        opts, args = getopt.getopt(argv[1:], "s:m:d:")
+        opts = dict(opts)
+        if '-s' in opts: sentences = int(opts['-s'])
+        if '-m' in opts: max_chars = int(opts['-m'])
+        if '-d' in opts: device = opts['-d']
+    except:
+        usage(argv[0])
+    page = Path(args[0]) if args else DEFAULT_PAGE
+
+    chunks = first_sentences(tts.iter_tts_chunks(page.read_text(encoding='utf-8')), sentences)
+    print(f"{page.name}: {sentences} sentences, {sum(len(c) for c in chunks)} characters")
+    pipeline = KPipeline(lang_code='a', device=device)
+    run(pipeline, chunks[:4], "warm up")
+    single = run(pipeline, chunks, "per sentence")
+    packed = run(pipeline, list(tts.pack_chunks(chunks, max_chars)), f"max {max_chars}")
+    print(f"packing speedup x{single/packed:.2f}")
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,134 @@
+"""
+Synthetic Literotica-style stories for the benchmarks, and a local HTTP server to fetch them from.
+
+Pages are generated from a fixed word list with a seeded random generator, so the same
+arguments always give the same corpus.  story_page() mimics the markup of a story page
+(paragraphs in div.aa_ht, a pager with links to every page); book_html() mimics the HTML
+that litero_book writes for a whole story.
+"""
+import random
+import threading
+from html import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+
+PAGES_DIR = Path(__file__).parent / "pages"
+
+WORDS = ("the a he she they at long slow quiet river rain road garden window door house home "
+         "hand heart voice light letter station morning evening never always again small "
+         "looked walked smiled asked said remembered").split()
+ENDS = ".?!"
+
+
+def sentence(rng):
+    words = [ rng.choice(WORDS) for _ in range(rng.randint(6, 18)) ]
+    if rng.random() < 0.1:
+        words[rng.randrange(len(words))] = "<em>quiet</em>"
+    return " ".join(words).capitalize() + rng.choice(ENDS)
+
+def paragraph(rng):
+    text = " ".join(sentence(rng) for _ in range(rng.randint(2, 5)))
+    return '"' + text if rng.random() < 0.1 else text
+
+def story_page(slug, title, page, pages, paragraphs, rng):
+    """Returns the HTML of one page of a story, with a pager linking to all of its pages."""
+    body = "\n".join(f"<p>{paragraph(rng)}</p>" for _ in range(paragraphs))
+    pager = "\n".join(f'<a class="l_bJ" href="https://www.literotica.com/s/{slug}?page={n}" title="Page {n}">{n}</a>'
+                      for n in range(1, pages + 1))
+    return f"""<!DOCTYPE html>
+<html lang="en">
+<head>
+<meta charset="utf-8">
+<title>{escape(title)} - Romance - Literotica.com</title>
+<script>window.__PRELOADED__ = {{"story": {{"pages": {pages}}}}};</script>
+</head>
+<body>
+<div class="page">
+<div class="panel article aa_eQ">
+<h1 class="j_bm headline j_eQ">{escape(title)}</h1>
+<div class="aa_ht"><div>
+{body}
+</div></div>
+<div class="panel clearfix l_bH">
+{pager}
+</div>
+<div class="related"><a href="https://www.literotica.com/s/another-story?page=7">Another Story</a></div>
+</div>
+</div>
+</body>
+</html>
+"""
+
+def story_pages(chapters=3, pages=3, paragraphs=40, seed=1):
+    """Returns {(slug, page): html} for a story of chapters x pages generated pages."""
+    rng = random.Random(seed)
+    result = {}
+    for c in range(1, chapters + 1):
+        slug = f"bench-story-ch-{c:02d}"
+        for p in range(1, pages + 1):
+            result[(slug, p)] = story_page(slug, f"Bench Story Ch. {c:02d}", p, pages, paragraphs, rng)
+    return result
+
+def saved_pages():
+    """Returns {(slug, 1): html} for the saved pages in bench/pages."""
+    return { (p.stem, 1): p.read_text(encoding='utf-8') for p in sorted(PAGES_DIR.glob("*.html")) }
+
+def book_html(chapters=3, pages=3, paragraphs=40, seed=1):
+    """Returns the HTML of a whole story in the form litero_book writes it."""
+    rng = random.Random(seed)
+    result = []
+    for c in range(1, chapters + 1):
+        result.append(f"<h1>Chapter {c}</h1>\n")
+        for p in range(1, pages + 1):
+            result.append(f"<h2>Page {p}</h2>\n")
+            result.extend(f"<p><p>{paragraph(rng)}</p></p>\n" for _ in range(paragraphs))
+            result.append("\n")
+        result.append("\n")
+    return "".join(result)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlparse(self.path)
+        slug = url.path.rstrip('/').split('/')[-1]
+        page = int(parse_qs(url.query).get('page', ['1'])[0])
+        body = self.server.pages.get((slug, page))
+        if body is None:
+            self.send_error(404)
+            return
+        data = body.encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class CorpusServer:
+    """
+    Serves pages at http://127.0.0.1:<port>/s/<slug>?page=<n> from a background thread.
+
+        with CorpusServer(story_pages()) as server:
+            url = server.url("bench-story-ch-01")
+    """
+    def __init__(self, pages):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), _Handler)
+        self.httpd.pages = pages
+        self.httpd.daemon_threads = True
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def url(self, slug):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/s/{slug}"
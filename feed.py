@@ -1,5 +1,33 @@
 from feedgen.feed import FeedGenerator
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from lxml import etree
+import getopt
+import hashlib
+import json
 import os
+import re
+import struct
+import sys
+import time
+
+try:
+    import mutagen  # type: ignore
+except ImportError:
+    mutagen = None  # type: ignore
+
+BASE_URL = "http://www.ank.com"
+ATOM_NS = "http://www.w3.org/2005/Atom"
+
+# MPEG audio frame header tables, indexed by the header's version and layer bits
+BITRATES = {  # kbit/s: (MPEG 1, MPEG 2/2.5) x layer 3, 2, 1
+    (1, 3): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (1, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (1, 1): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (2, 3): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (2, 1): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+}
 
 class EroFeed:
     def __init__(self):
@@ -14,69 +42,285 @@ class EroFeed:
         fg.podcast.itunes_category('Fiction', 'Erotica')
         fg.podcast.itunes_explicit("yes")
         self.fg = fg
+        self.links = []
 
-    def add_entry(self, epid, title, desc, size, link=None):
-        print("Title:", title)
-        print("Description:", desc)
+    def add_entry(self, epid, title, desc, size, link=None, published=None, duration=None):
         if link is None: link = epid
-        fe = self.fg.add_entry()
+        fe = self.fg.add_entry(order='append')
         fe.id(epid)
         fe.title(title)
         # fe.link(href=link)
         fe.description(desc)
         fe.enclosure(link, str(size), 'audio/mpeg')
+        if published is not None:
+            fe.pubDate(datetime.fromtimestamp(published, timezone.utc))
+        if duration:
+            fe.podcast.itunes_duration(round(duration))
+
+    def add_link(self, rel, href):
+        """Adds an atom:link to the channel, e.g. the archive pages of a paged feed (RFC 5005)."""
+        self.links.append((rel, href))
+
+    def save(self, path='ero.atom'):
+        """Writes the feed, serialised once, to a temporary file renamed into place."""
+        data = self.fg.rss_str(pretty=True)
+        if self.links:
+            # feedgen only writes rel="self" links into RSS, so the paging links are added here
+            feed = etree.fromstring(data, etree.XMLParser(remove_blank_text=True))
+            channel = feed.find('channel')
+            for rel, href in self.links:
+                etree.SubElement(channel, f'{{{ATOM_NS}}}link', rel=rel, href=href)
+            data = etree.tostring(feed, pretty_print=True, encoding='UTF-8', xml_declaration=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+
+class EpisodeIndex:
+    """
+    Persistent index of the episodes found under the audio directories, in a local JSON file.
+
+    Each mp3 is recorded by path with its size and mtime, and each directory with its mtime
+    and subdirectories.  A directory whose mtime has not changed since it was indexed is not
+    listed again, since adding, removing or replacing (by rename) a file in it changes its
+    mtime; only its subdirectories are checked.  An episode keeps the time it was first seen,
+    which orders the feed, so new episodes are always appended.
+    """
+    def __init__(self, path="./cache/feed.json"):
+        self.path = path
+        self.dirs = {}
+        self.entries = {}
+        self.pages = {}
+        if os.path.isfile(path):
+            with open(path, "rt") as f:
+                record = json.load(f)
+            self.dirs, self.entries, self.pages = record['dirs'], record['episodes'], record.get('pages', {})
+
+    def __repr__(self):
+        return f"EpisodeIndex({self.path}, {len(self.entries)} episodes)"
+
+    def scan(self, basedir, story=""):
+        """Brings the index up to date with basedir and its subdirectories; returns the number of directories listed."""
+        mtime = os.stat(basedir).st_mtime_ns
+        known = self.dirs.get(basedir)
+        listed = 0
+        if known is None or known['mtime'] != mtime:
+            print(f"Scanning {basedir}")
+            known = self._list(basedir, story, mtime)
+            listed = 1
+        for name in known['subdirs']:
+            listed += self.scan(basedir + "/" + name, name)
+        return listed
+
+    def _list(self, basedir, story, mtime):
+        subdirs = []
+        found = set()
+        now = time.time()
+        with os.scandir(basedir) as it:
+            for entry in it:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.is_file() and entry.name.endswith(".mp3"):
+                    path = basedir + "/" + entry.name
+                    st = entry.stat()
+                    found.add(path)
+                    episode = self.entries.get(path)
+                    if episode is None:
+                        print(f" - Adding {path}")
+                        episode = self.entries[path] = { 'story': story, 'added': now,
+                                                         'url': f"{BASE_URL}/audio/{story}/{entry.name}" }
+                    if (episode.get('size'), episode.get('mtime')) != (st.st_size, st.st_mtime_ns):
+                        # a new or replaced file: probed again
+                        episode.pop('duration', None)
+                    episode['size'] = st.st_size
+                    episode['mtime'] = st.st_mtime_ns
+        for path in [ p for p in self.entries if os.path.dirname(p) == basedir and p not in found ]:
+            print(f" - Removing {path}")
+            del self.entries[path]
+        for name in set(self.dirs.get(basedir, {}).get('subdirs', [])) - set(subdirs):
+            self.forget(basedir + "/" + name)
+        self.dirs[basedir] = { 'mtime': mtime, 'subdirs': sorted(subdirs) }
+        return self.dirs[basedir]
+
+    def forget(self, basedir):
+        """Removes a directory that no longer exists, its subdirectories and their episodes."""
+        prefix = basedir + "/"
+        for path in [ p for p in self.entries if p.startswith(prefix) ]:
+            del self.entries[path]
+        for path in [ d for d in self.dirs if d == basedir or d.startswith(prefix) ]:
+            del self.dirs[path]
+
+    def probe(self, workers=8):
+        """Reads the duration and bitrate of the episodes not probed yet, workers files at a time.
+        A file that cannot be read is left unprobed, and tried again on the next run.
+        Returns the number of files probed."""
+        todo = [ path for path, episode in self.entries.items() if episode.get('duration') is None ]
+        if not todo:
+            return 0
+        print(f"Probing {len(todo)} files")
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for path, info in zip(todo, pool.map(probe, todo)):
+                if info is not None:
+                    self.entries[path].update(info)
+        return len(todo)
+
+    def episodes(self):
+        """Returns the episodes in the order they were first seen, each with its path, title and part number."""
+        stories = {}
+        for path, episode in self.entries.items():
+            stories.setdefault(os.path.dirname(path), []).append(path)
+        result = []
+        for paths in stories.values():
+            paths.sort(key=natural_key)
+            for part, path in enumerate(paths, 1):
+                episode = dict(self.entries[path], path=path, part=part)
+                episode['title'] = f"{episode['story']} ({part} of {len(paths)})"
+                result.append(episode)
+        result.sort(key=lambda e: (e['added'], natural_key(e['path'])))
+        return result
 
     def save(self):
-        self.fg.rss_str(pretty=True)
-        self.fg.rss_file('ero.atom')
-
-def scan(basedir, ero, story=""):
-    part = 1
-    mp3s = []
-    with os.scandir(basedir) as it:
-        for entry in it:
-            if entry.is_dir():
-                subdir = basedir + "/" + entry.name
-                story = entry.name
-                print(f"Scanning {subdir}")
-                scan(subdir, ero, story)
-            elif entry.is_file() and entry.name.endswith(".mp3"):
-                path = basedir + "/" + entry.name
-                url = f"http://www.ank.com/audio/{story}/{entry.name}"
-                mp3s.append({ 'url': url, 'path': path, 'story': story})
-
-        parts = len(mp3s)
-        for mp3 in mp3s:
-                url = mp3['url']
-                path = mp3['path']
-                story = mp3['story']
-                title = f"{story} ({part} of {parts})"
-                print(f" - Adding {title}")
-                size = os.path.getsize(path)
-                ero.add_entry(url, title, path, size)
-                part += 1
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "wt") as f:
+            json.dump({ 'dirs': self.dirs, 'episodes': self.entries, 'pages': self.pages }, f)
+        os.replace(self.path + ".tmp", self.path)
 
-def main(argv):
-    flist = argv[1]
-    ero = EroFeed()
-    with open(flist, "rt") as f:
-        while True:
-            url = f.readline()
-            if not url: break
-            url = url.strip('\n')
-            title = os.path.basename(url)
-            scan(f"audio/{title}", ero, title)
-    ero.save()
 
+def natural_key(path):
+    """Sort key ordering the numbers in a name by value: part2.mp3 before part10.mp3."""
+    return [ int(s) if s.isdigit() else s for s in re.split(r'(\d+)', path) ]
+
+def probe(path):
+    """
+    Returns {'duration', 'bitrate'} of an mp3, in seconds and bit/s, or None if it cannot be read.
+    mutagen reads them when it is installed; when it is not, or fails on the file, the duration
+    and bitrate are estimated from the first frame header, which is exact for constant bitrate
+    files such as Polly's.
+    """
+    if mutagen is not None:
+        try:
+            audio = mutagen.File(path)
+            if audio is not None and audio.info is not None:
+                return { 'duration': audio.info.length, 'bitrate': getattr(audio.info, 'bitrate', None) }
+        except Exception as ex:
+            print(f"mutagen cannot read {path}, using the frame header: {ex}")
+    try:
+        return mp3_header_info(path)
+    except Exception as ex:
+        print(f"Unable to probe {path}: {ex}")
+        return None
 
-def bar():
+def mp3_header_info(path):
+    """Estimates the duration and bitrate of an mp3 from its first frame, after any ID3v2 tag."""
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(10)
+        offset = 0
+        if head[:3] == b"ID3":
+            # the tag size is a 28 bit "synchsafe" integer
+            offset = 10 + ((head[6] << 21) | (head[7] << 14) | (head[8] << 7) | head[9])
+        f.seek(offset)
+        data = f.read(64 * 1024)
+    for i in range(len(data) - 4):
+        if data[i] != 0xFF or data[i+1] & 0xE0 != 0xE0:
+            continue
+        header, = struct.unpack(">I", data[i:i+4])
+        version = (header >> 19) & 3  # 3: MPEG 1, 2: MPEG 2, 0: MPEG 2.5
+        layer = 4 - ((header >> 17) & 3)
+        index = (header >> 12) & 15
+        rate = (header >> 10) & 3
+        if version == 1 or layer == 4 or index in (0, 15) or rate == 3:
+            continue
+        bitrate = BITRATES[(1 if version == 3 else 2, layer)][index] * 1000
+        return { 'duration': (size - offset - i) * 8 / bitrate, 'bitrate': bitrate }
+    raise ValueError("no MPEG audio frame found")
+
+def page_path(path, page):
+    """Returns the file of an archive page of the feed at path: ero.atom -> ero-<page>.atom."""
+    base, ext = os.path.splitext(path)
+    return f"{base}-{page}{ext}"
+
+def write_page(episodes, path, links, written):
+    """Writes one file of the feed unless it already holds these episodes.  Returns True if written."""
+    digest = hashlib.sha256(json.dumps([ (e['url'], e['title'], e['size'], e['mtime'], e.get('duration')) for e in episodes ]
+                                       + links).encode('utf-8')).hexdigest()
+    name = os.path.basename(path)
+    if written.get(name) == digest and os.path.isfile(path):
+        return False
     ero = EroFeed()
-    scan("audio", ero)
-    ero.save()
+    for rel, href in links:
+        ero.add_link(rel, href)
+    # newest first, as feed readers expect
+    for episode in reversed(episodes):
+        ero.add_entry(episode['url'], episode['title'], episode['path'], episode['size'], published=episode['added'],
+                      duration=episode.get('duration'))
+    ero.save(path)
+    written[name] = digest
+    return True
+
+def write_feed(index, path='ero.atom', page_size=None):
+    """
+    Writes the feed of the indexed episodes at path.  With page_size, the feed only holds the
+    newest episodes: the older ones fill archive pages of page_size episodes each, numbered
+    from the oldest (ero-1.atom, ...) so that a full page never changes, linked together as
+    in RFC 5005.  Files whose episodes have not changed are not written again.
+    """
+    episodes = index.episodes()
+    url = lambda p: f"{BASE_URL}/{os.path.basename(p)}"
+    if not page_size or len(episodes) <= page_size:
+        if write_page(episodes, path, [], index.pages):
+            print(f"Wrote {path}: {len(episodes)} episodes")
+        return
+    archived = (len(episodes) - 1) // page_size
+    for page in range(1, archived + 1):
+        links = [ ('current', url(path)) ]
+        if page > 1:
+            links.append(('prev-archive', url(page_path(path, page - 1))))
+        if page < archived:
+            links.append(('next-archive', url(page_path(path, page + 1))))
+        if write_page(episodes[(page - 1) * page_size:page * page_size], page_path(path, page), links, index.pages):
+            print(f"Wrote {page_path(path, page)}")
+    current = episodes[archived * page_size:]
+    if write_page(current, path, [ ('prev-archive', url(page_path(path, archived))) ], index.pages):
+        print(f"Wrote {path}: {len(current)} of {len(episodes)} episodes")
 
+def usage(app):
+        print(f"Usage: python {app} [-i <index>] [-p <page-size>] [-j <jobs>] [-o <feed>] [<list-of-story-urls.txt>]")
+        print("   -i : Episode index, default './cache/feed.json'")
+        print("   -p : Episodes in the feed, older ones are moved to archive pages; default, all in one feed")
+        print("   -j : Files probed for their duration at a time, default 8")
+        print("   -o : Feed file, default 'ero.atom'")
+        print("   Without a list, every story under ./audio is scanned.")
+        sys.exit(1)
+
+def main(argv):
+    index_path = "./cache/feed.json"
+    page_size = None
+    feed_path = "ero.atom"
+    workers = 8
+    try:
+        opts, args = getopt.getopt(argv[1:], "i:p:j:o:")
+        opts = dict(opts)
+        if '-i' in opts: index_path = opts['-i']
+        if '-p' in opts: page_size = int(opts['-p'])
+        if '-j' in opts: workers = int(opts['-j'])
+        if '-o' in opts: feed_path = opts['-o']
+    except:
+        usage(argv[0])
 
+    index = EpisodeIndex(index_path)
+    if args:
+        with open(args[0], "rt") as f:
+            for url in f.read().split('\n'):
+                if url.strip():
+                    title = os.path.basename(url.strip())
+                    index.scan(f"audio/{title}", title)
+    else:
+        index.scan("audio")
+    index.probe(workers)
+    write_feed(index, feed_path, page_size)
+    index.save()
 
 
 if __name__ == "__main__":
-    import sys
     main(sys.argv)
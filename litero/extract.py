@@ -0,0 +1,177 @@
+import re
+from html import escape
+from html.parser import HTMLParser
+
+try:
+    from lxml import etree  # type: ignore
+except ImportError:
+    etree = None  # type: ignore
+
+try:
+    from bs4 import BeautifulSoup  # type: ignore
+except ImportError:
+    BeautifulSoup = None  # type: ignore
+
+
+HAS_TEXT = re.compile('[A-Za-z]{3}') # search for at least a 3-letter word to avoid picking up junk
+CLEANR = re.compile('<.*?>')
+STORY_CLASS = 'aa_ht'
+VOID_TAGS = { 'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta', 'source', 'track', 'wbr' }
+
+
+class Paragraph:
+    """A story paragraph as plain text and as its '<p>' element HTML.  str() gives the HTML."""
+    __slots__ = ('text', 'html')
+
+    def __init__(self, text, html):
+        self.text = text
+        self.html = html
+
+    def __str__(self):
+        return self.html
+
+    def __repr__(self):
+        return f"Paragraph({self.text[:40]!r})"
+
+
+class Extractor:
+    """
+    Extracts the story paragraphs, the '<p>' elements inside '<div class="aa_ht">', from a page.
+    Subclasses implement paragraphs(); paragraphs without at least one word are skipped.
+    """
+    name = None
+
+    def paragraphs(self, body):
+        """Returns the list of Paragraph objects of the story body of a page."""
+        raise NotImplementedError()
+
+    def extract(self, body, textonly=False):
+        """Returns the paragraphs of a page as plain text, or as Paragraph objects."""
+        paras = [ p for p in self.paragraphs(body) if HAS_TEXT.search(p.text) ]
+        if textonly:
+            return [ p.text for p in paras ]
+        return paras
+
+
+class SoupExtractor(Extractor):
+    """The original BeautifulSoup html.parser extraction, kept as the reference implementation."""
+    name = 'soup'
+
+    def __init__(self):
+        if BeautifulSoup is None:
+            raise RuntimeError("BeautifulSoup is required for the soup extractor.")
+
+    def paragraphs(self, body):
+        soup = BeautifulSoup(body, 'html.parser')
+        result = []
+        for e in soup.find_all('div', {'class': STORY_CLASS}):
+            for para in e.find_all('p'):
+                html = str(para)
+                result.append(Paragraph(re.sub(CLEANR, '', html), html))
+        return result
+
+
+class _StoryParser(HTMLParser):
+    """Event parser that only keeps the '<p>' elements inside the story divs."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paras = []
+        self.story_depth = 0   # open divs counted from the story div, 0 outside of it
+        self.text = None       # text of the open paragraph, None outside of a paragraph
+        self.html = None
+
+    def _end_para(self):
+        if self.text is not None:
+            self.html.append('</p>')
+            self.paras.append(Paragraph(''.join(self.text), ''.join(self.html)))
+            self.text = self.html = None
+
+    def _tag(self, tag, attrs, close=''):
+        parts = [ '<', tag ]
+        for k, v in attrs:
+            parts.append(f' {k}' if v is None else f' {k}="{escape(v)}"')
+        parts.append(close + '>')
+        return ''.join(parts)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'div':
+            if self.story_depth:
+                self.story_depth += 1
+            elif STORY_CLASS in (dict(attrs).get('class') or '').split():
+                self.story_depth = 1
+            return
+        if not self.story_depth:
+            return
+        if tag == 'p':
+            self._end_para()
+            self.text = []
+            self.html = [ self._tag(tag, attrs) ]
+        elif self.text is not None:
+            self.html.append(self._tag(tag, attrs, '/' if tag in VOID_TAGS else ''))
+
+    def handle_startendtag(self, tag, attrs):
+        if self.text is not None:
+            self.html.append(self._tag(tag, attrs, '/'))
+
+    def handle_endtag(self, tag):
+        if tag == 'div':
+            if self.story_depth:
+                self.story_depth -= 1
+                if not self.story_depth:
+                    self._end_para()
+        elif self.text is not None:
+            if tag == 'p':
+                self._end_para()
+            elif tag not in VOID_TAGS:
+                self.html.append(f'</{tag}>')
+
+    def handle_data(self, data):
+        if self.text is not None:
+            self.text.append(data)
+            self.html.append(escape(data, quote=False))
+
+
+class StreamExtractor(Extractor):
+    """Single-pass event parser using the standard library; no document tree is built."""
+    name = 'stream'
+
+    def paragraphs(self, body):
+        parser = _StoryParser()
+        parser.feed(body)
+        parser.close()
+        parser._end_para()
+        return parser.paras
+
+
+class LxmlExtractor(Extractor):
+    """libxml2 based extraction; parsing runs in C and releases the GIL."""
+    name = 'lxml'
+    STORY_XPATH = f"//div[contains(concat(' ', normalize-space(@class), ' '), ' {STORY_CLASS} ')]//p"
+
+    def __init__(self):
+        if etree is None:
+            raise RuntimeError("lxml is required for the lxml extractor.")
+        self.xpath = etree.XPath(self.STORY_XPATH)
+
+    def paragraphs(self, body):
+        root = etree.fromstring(body, etree.HTMLParser(encoding='utf-8') if isinstance(body, bytes) else etree.HTMLParser())
+        if root is None:
+            return []
+        return [
+            Paragraph(''.join(p.itertext()), etree.tostring(p, method='html', encoding='unicode', with_tail=False))
+            for p in self.xpath(root)
+        ]
+
+
+EXTRACTORS = { e.name: e for e in (LxmlExtractor, StreamExtractor, SoupExtractor) }
+
+def get_extractor(name=None):
+    """
+    Returns an extractor by name ('lxml', 'stream' or 'soup').  By default the fastest available
+    one is used: lxml when it is installed, otherwise the standard library event parser.
+    """
+    if name is None:
+        name = 'lxml' if etree is not None else 'stream'
+    if name not in EXTRACTORS:
+        raise Exception(f"Unknown extractor {name}")
+    return EXTRACTORS[name]()
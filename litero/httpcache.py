@@ -0,0 +1,140 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import zlib
+
+
+class CacheEntry:
+    """A cached HTTP response body together with its validators."""
+    def __init__(self, url, body, etag, last_modified, fetched):
+        self.url = url
+        self.body = body
+        self.etag = etag
+        self.last_modified = last_modified
+        self.fetched = fetched
+
+    def validators(self):
+        """Returns the request headers for a conditional GET of this entry."""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class HttpCache:
+    """
+    Persistent on-disk cache of HTTP response bodies, keyed by URL.
+
+    Bodies are stored zlib-compressed, one file per URL, and indexed in a SQLite database that
+    also holds the ETag/Last-Modified validators and the last access time used for LRU eviction.
+    The cache is safe to share between the fetch threads of a Litero client.
+    """
+    def __init__(self, cache_dir="./cache/http", max_bytes=512*1024*1024, max_age=24*3600, offline=False):
+        """
+        Args:
+            cache_dir: Directory holding the index and the compressed bodies.
+            max_bytes: Upper bound on the total compressed size; least recently used entries are evicted beyond it.
+            max_age: Seconds an entry is served without revalidation.  None always revalidates.
+            offline: Never touch the network; only cached entries can be fetched.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.offline = offline
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            url TEXT PRIMARY KEY,
+            etag TEXT,
+            last_modified TEXT,
+            size INTEGER NOT NULL,
+            fetched REAL NOT NULL,
+            accessed REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+        self.db.commit()
+        self.total = self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def __repr__(self):
+        return f"HttpCache({self.cache_dir}, {self.total} bytes)"
+
+    def _body_path(self, url):
+        digest = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.cache_dir, digest[:2], digest + ".z")
+
+    def lookup(self, url):
+        """Returns the CacheEntry for url, or None if it is not cached."""
+        with self.lock:
+            row = self.db.execute(
+                "SELECT etag, last_modified, fetched FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is None:
+                return None
+            try:
+                with open(self._body_path(url), "rb") as f:
+                    body = zlib.decompress(f.read())
+            except (OSError, zlib.error):
+                self._remove(url)
+                self.db.commit()
+                return None
+            self.db.execute("UPDATE entries SET accessed = ? WHERE url = ?", (time.time(), url))
+            self.db.commit()
+        etag, last_modified, fetched = row
+        return CacheEntry(url, body, etag, last_modified, fetched)
+
+    def is_fresh(self, entry):
+        """True if entry may be served without revalidating it with the server."""
+        return self.max_age is not None and time.time() - entry.fetched < self.max_age
+
+    def store(self, url, body, etag=None, last_modified=None):
+        """Stores a response body and its validators, evicting old entries if the cache is full."""
+        data = zlib.compress(body, 6)
+        path = self._body_path(url)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        now = time.time()
+        with self.lock:
+            os.replace(tmp, path)
+            row = self.db.execute("SELECT size FROM entries WHERE url = ?", (url,)).fetchone()
+            if row is not None:
+                self.total -= row[0]
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, len(data), now, now))
+            self.total += len(data)
+            self._evict()
+            self.db.commit()
+
+    def revalidated(self, url):
+        """Marks an entry as confirmed current by the server (HTTP 304)."""
+        now = time.time()
+        with self.lock:
+            self.db.execute("UPDATE entries SET fetched = ?, accessed = ? WHERE url = ?", (now, now, url))
+            self.db.commit()
+
+    def _remove(self, url):
+        row = self.db.execute("SELECT size FROM entries WHERE url = ?", (url,)).fetchone()
+        if row is None:
+            return
+        self.db.execute("DELETE FROM entries WHERE url = ?", (url,))
+        self.total -= row[0]
+        try:
+            os.remove(self._body_path(url))
+        except FileNotFoundError:
+            pass
+
+    def _evict(self):
+        if self.total <= self.max_bytes:
+            return
+        for url, in self.db.execute("SELECT url FROM entries ORDER BY accessed").fetchall():
+            self._remove(url)
+            if self.total <= self.max_bytes:
+                break
+
+    def close(self):
+        with self.lock:
+            self.db.close()
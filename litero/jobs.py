@@ -0,0 +1,160 @@
+import heapq
+import sqlite3
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from . import metrics
+
+NEW = 'new'
+
+
+class JobManifest:
+    """
+    Persistent record, in a SQLite file, of the stage each story of a batch has reached.
+    A stage is only recorded once it has completed, so a batch resumes where it stopped.
+    """
+    def __init__(self, path="./jobs.sqlite"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            ref TEXT PRIMARY KEY,
+            stage TEXT NOT NULL,
+            error TEXT,
+            updated REAL NOT NULL)""")
+        self.db.commit()
+
+    def __repr__(self):
+        return f"JobManifest({self.path})"
+
+    def add(self, ref):
+        """Adds a story to the manifest, keeping its stage if it is already known."""
+        with self.lock:
+            self.db.execute("INSERT OR IGNORE INTO jobs VALUES (?, ?, NULL, ?)", (ref, NEW, time.time()))
+            self.db.commit()
+
+    def stage(self, ref):
+        """Returns the last stage completed by a story, or None if it is not in the manifest."""
+        with self.lock:
+            row = self.db.execute("SELECT stage FROM jobs WHERE ref = ?", (ref,)).fetchone()
+        return row[0] if row else None
+
+    def advance(self, ref, stage):
+        """Records that a story has completed a stage, clearing any earlier error."""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET stage = ?, error = NULL, updated = ? WHERE ref = ?", (stage, time.time(), ref))
+            self.db.commit()
+
+    def fail(self, ref, error):
+        """Records the error that stopped a story; it is retried from its last stage on the next run."""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET error = ?, updated = ? WHERE ref = ?", (str(error), time.time(), ref))
+            self.db.commit()
+
+    def rewind(self, ref, stage):
+        """Moves a story back to an earlier stage, so the stages after it run again."""
+        with self.lock:
+            self.db.execute("UPDATE jobs SET stage = ?, updated = ? WHERE ref = ?", (stage, time.time(), ref))
+            self.db.commit()
+
+    def jobs(self):
+        """Returns (ref, stage, error) for every story in the manifest."""
+        with self.lock:
+            return self.db.execute("SELECT ref, stage, error FROM jobs ORDER BY ref").fetchall()
+
+
+class Scheduler:
+    """
+    Drives many stories concurrently through a fixed sequence of stages.
+
+    Each stage is a (name, handler) pair.  handler(job) returns True once the stage is complete,
+    or False if it is waiting on something outside (e.g. a Polly task) and should be retried
+    after retry_delay seconds; meanwhile the worker is free for other stories.  A story still
+    waiting after max_attempts tries is given up on, as is one whose handler raises: it is marked
+    as failed without stopping the batch.  The job object passed to the handlers is created by
+    make_job(ref) when a story starts and dropped once it is done or has failed.
+    """
+    def __init__(self, manifest : JobManifest, stages, make_job, workers=4, retry_delay=30, max_attempts=20):
+        self.manifest = manifest
+        self.stages = stages
+        self.make_job = make_job
+        self.workers = workers
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.jobs = {}
+
+    def _next_stages(self, ref):
+        names = [ name for name, _ in self.stages ]
+        stage = self.manifest.stage(ref)
+        start = 0 if stage == NEW else names.index(stage) + 1
+        return self.stages[start:]
+
+    def _advance(self, ref):
+        """Runs a story through its remaining stages.  Returns False if it has to wait and be retried."""
+        try:
+            if ref not in self.jobs:
+                self.jobs[ref] = self.make_job(ref)
+            job = self.jobs[ref]
+            for name, handler in self._next_stages(ref):
+                start = time.perf_counter()
+                outcome = 'failed'
+                try:
+                    done = handler(job)
+                    outcome = 'done' if done else 'waiting'
+                finally:
+                    metrics.observe('litero_stage_seconds', time.perf_counter() - start, stage=name, outcome=outcome)
+                if not done:
+                    return False
+                self.manifest.advance(ref, name)
+                print(f"{ref}: {name}")
+            metrics.count('litero_stories_total', outcome='done')
+        except Exception as ex:
+            self._fail(ref, ex)
+            return True
+        self.jobs.pop(ref, None)
+        return True
+
+    def _fail(self, ref, error):
+        print(f"{ref}: FAILED {error}")
+        self.manifest.fail(ref, error)
+        metrics.count('litero_stories_total', outcome='failed')
+        # the job may hold a whole fetched story
+        self.jobs.pop(ref, None)
+
+    def run(self, refs):
+        """Runs every story in refs to the final stage or to a failure."""
+        final = self.stages[-1][0]
+        todo = deque()
+        for ref in refs:
+            self.manifest.add(ref)
+            if self.manifest.stage(ref) == final:
+                print(f"{ref}: already {final}")
+            else:
+                todo.append(ref)
+
+        delayed = []  # heap of (ready time, ref)
+        running = {}
+        attempts = {}
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while todo or delayed or running:
+                now = time.time()
+                while delayed and delayed[0][0] <= now:
+                    todo.append(heapq.heappop(delayed)[1])
+                while todo and len(running) < self.workers:
+                    ref = todo.popleft()
+                    running[pool.submit(self._advance, ref)] = ref
+                timeout = max(0, delayed[0][0] - now) if delayed else None
+                if not running:
+                    time.sleep(timeout)
+                    continue
+                done, _ = wait(running, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    ref = running.pop(future)
+                    if future.result():
+                        continue
+                    attempts[ref] = attempts.get(ref, 0) + 1
+                    if attempts[ref] >= self.max_attempts:
+                        self._fail(ref, f"still waiting after {attempts[ref]} attempts")
+                    else:
+                        heapq.heappush(delayed, (time.time() + self.retry_delay, ref))
@@ -1,94 +1,245 @@
 
 
 import requests
+from requests.adapters import HTTPAdapter
 import re
-from bs4 import BeautifulSoup
 import keyring
 from time import sleep
+from concurrent.futures import ThreadPoolExecutor
 from .pollyclient import PollyClient
 from .story import Story, StoryRefType
+from .httpcache import HttpCache
+from .synthcache import SynthesisCache
+from .extract import Extractor, get_extractor
+from .packer import pack_parts, text_file_paragraphs, POLLY_MAX_BILLED
+from . import metrics
 import os
 
 
+MAX_PAGES = 100 # limit to 100 pages per chapter in case of bugs
+
+PAGE_LINK = re.compile(r'href="[^"]*/s/([^"?/]+)\?page=(\d+)"')
+# the caption is an element of its own, e.g. <span class="b-pager-caption-t">5 Pages:</span>,
+# so "N Pages:" in the story text is not taken for it
+PAGE_CAPTION = re.compile(r'>\s*(\d+)\s+Pages:\s*<')
+def parse_page_count(raw_html, slug=None):
+    """Reads the number of pages of a chapter from the pagination markup of one of its pages.
+
+    Both the pager links ('/s/<slug>?page=N') and the older 'N Pages:' caption element are recognised;
+    links to other stories are ignored when the chapter slug is given.  A page without
+    pagination is the only page of its chapter.
+    """
+    count = 1
+    for m in PAGE_CAPTION.finditer(raw_html):
+        count = max(count, int(m.group(1)))
+    for m in PAGE_LINK.finditer(raw_html):
+        if slug is None or m.group(1) == slug:
+            count = max(count, int(m.group(2)))
+    return count
+
 CLEANR = re.compile('<.*?>')
 def cleanhtml(raw_html):
     """Removes HTML tags from a string."""
     txt = re.sub(CLEANR, '', raw_html)
     return txt
 
+def make_session(max_workers=8):
+    """Creates a requests session whose connection pool can keep max_workers connections open per host."""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
 class Litero:
-    def __init__(self, story:Story, voice = None):
+    def __init__(self, story:Story, voice = None, session = None, max_workers = 8, cache : HttpCache = None, extractor : Extractor = None,
+                 synth_cache : SynthesisCache = None, polly_options : dict = None):
+        """
+        Args:
+            story: The story to fetch.
+            voice: Polly voice used for reading.
+            session: Shared requests session; a pooled session is created if not given.
+            max_workers: Maximum number of page fetches in flight at a time.
+            cache: Optional on-disk HTTP cache used by get().
+            extractor: Paragraph extractor; the fastest available one by default.
+            synth_cache: Optional cache of audio already synthesised by Polly.
+            polly_options: Extra keyword arguments for the PollyClient, e.g. a shared rate limiter.
+        """
         self.headers = requests.utils.default_headers()
         self.headers['User-Agent'] = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/97.0.4692.71 Safari/537.36'
         self.base_url = "http://www.literotica.com"
         self.voice = voice
         self.story = story
+        self.max_workers = max_workers
+        self.session = session if session is not None else make_session(max_workers)
+        self.timeout = 30
+        self.cache = cache
+        self.extractor = extractor if extractor is not None else get_extractor()
+        self._pages = None
+        self._polly = None
+        self.synth_cache = synth_cache
+        self.polly_options = polly_options or {}
         print(f"story {story}...")
-        if story.reftype == StoryRefType.LOCALFILE:
-            story_text = self.get_story_file(story)
-        elif story.reftype == StoryRefType.LITERO:
-            story_text = self.get_full_story_txt(story)
-        else:
+        if story.reftype not in (StoryRefType.LOCALFILE, StoryRefType.LITERO):
             raise Exception(f"Unimplemented ref type {story.reftype}")
-        self.polly = PollyClient(story, story_text, voice=self.voice)
+
+    @property
+    def polly(self):
+        """The PollyClient reading this story; the story text is only fetched when the client uses it."""
+        if self._polly is None:
+            if self.story.reftype == StoryRefType.LOCALFILE:
+                story_text = self.get_story_file(self.story)
+            else:
+                story_text = self.get_full_story_txt(self.story)
+            self._polly = PollyClient(self.story, story_text, voice=self.voice, cache=self.synth_cache, **self.polly_options)
+        return self._polly
 
     def get(self, url):
-        resp = requests.get(url, headers=self.headers)
+        """Fetches a URL, serving it from the cache when possible and revalidating stale entries."""
+        entry = self.cache.lookup(url) if self.cache else None
+        if entry is not None and (self.cache.offline or self.cache.is_fresh(entry)):
+            metrics.count('litero_http_requests_total', source='cache')
+            return entry.body.decode('UTF-8')
+        if self.cache and self.cache.offline:
+            raise Exception(f"Not cached (offline): {url}")
+
+        headers = self.headers
+        if entry is not None:
+            headers = dict(self.headers, **entry.validators())
+        with metrics.timer('litero_http_request_seconds'):
+            resp = self.session.get(url, headers=headers, timeout=self.timeout)
         print(f"fetch {url} response code {resp.status_code}")
+        metrics.count('litero_http_requests_total', source='network', status=str(resp.status_code))
+        metrics.count('litero_http_bytes_total', len(resp.content))
+        if resp.status_code == 304 and entry is not None:
+            self.cache.revalidated(url)
+            return entry.body.decode('UTF-8')
         if resp.status_code != 200:
             raise Exception(f"Unable to fetch url: {url}")
+        if self.cache:
+            self.cache.store(url, resp.content, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
         return resp.content.decode('UTF-8')
 
+    def page_url(self, story_ref, page):
+        """Returns the URL of a page of a story chapter."""
+        if not story_ref.startswith('http'):
+            return self.base_url + "/s/" + story_ref + "?page=" + str(page)
+        return story_ref + "?page=" + str(page)
+
+    def parse_page(self, body, textonly=False, slug=None):
+        """Extracts the story paragraphs and the chapter page count from a fetched page.
+        Args:
+            body: The HTML of the page.
+            textonly: If True, returns plain text; otherwise, returns Paragraph objects.
+            slug: The chapter's story slug, used to recognise its pagination links.
+        Returns:
+            (paragraphs, page_count) where paragraphs is a list of text or Paragraph objects.
+        """
+        with metrics.timer('litero_parse_seconds'):
+            paras = self.extractor.extract(body, textonly)
+            return paras, parse_page_count(body, slug)
+
     def fetch_story_content(self, story_ref, page=1, textonly=False):
         """Fetches the story from a given story reference and page number as a generator.
         Args:
             story_ref: The URL or local file path of the story chapter.
             page: The page number to fetch.
-            textonly: If True, returns plain text; otherwise, returns HTML elements.
+            textonly: If True, returns plain text; otherwise, returns Paragraph objects.
         Yields:
-            The text or HTML elements of the story.
+            The text or Paragraph objects of the story.
         """
-        if not story_ref.startswith('http'):
-            story_ref = self.base_url + "/s/" + story_ref + "?page=" + str(page)
-        else:
-            story_ref = story_ref + "?page=" + str(page)
-        body = self.get(story_ref)
-        soup = BeautifulSoup(body, 'html.parser')
+        paras, _ = self.fetch_page(story_ref, page, textonly)
+        yield from paras
+
+    def fetch_page(self, story_ref, page, textonly=False):
+        """Fetches a single page of a chapter.
+        Returns:
+            (paragraphs, page_count) as returned by parse_page().
+        """
+        body = self.get(self.page_url(story_ref, page))
+        slug = story_ref.rstrip('/').split('/')[-1]
+        return self.parse_page(body, textonly, slug)
+
+    def fetch_chapter_pages(self, story : Story, chapters=None, textonly=False):
+        """Fetches the pages of one or more chapters of a story concurrently.
+
+        Up to max_workers pages are in flight at once over the shared session.  The page count
+        of each chapter is read from the pagination of its first page and recorded in the story,
+        so the remaining pages are scheduled as soon as the first page arrives.  When a count is
+        already recorded from an earlier run, all pages are scheduled up front.  A page that
+        fails to fetch raises.
 
-        HAS_TEXT = re.compile('[A-Za-z]{3}') # search for at least a 3-letter word to avoid picking up junk
+        Args:
+            story: The story to fetch.
+            chapters: List of Chapter handles to fetch; defaults to all chapters of the story.
+            textonly: If True, paragraphs are plain text; otherwise, Paragraph objects.
+        Yields:
+            (chapter, page, paragraphs) tuples in document order.
+        """
+        if chapters is None:
+            chapters = story.get_chapters()
 
-        for e in soup.find_all('div', {'class': 'aa_ht'}):
-            for para in e.find_all('p'):
-                txt = cleanhtml(str(para))
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            def first_page(ref, known):
+                paras, count = self.fetch_page(ref, 1, textonly)
+                count = min(count, MAX_PAGES)
+                extra = [ pool.submit(self.fetch_page, ref, page, textonly) for page in range(known+1, count+1) ]
+                return paras, count, extra
 
-                if re.search(HAS_TEXT, txt):
-                    if textonly:
-                        yield txt
-                    else:
-                        yield para
+            scheduled = []
+            for chapter in chapters:
+                known = min(story.get_page_count(chapter.index) or 1, MAX_PAGES)
+                first = pool.submit(first_page, chapter.ref, known)
+                rest = [ pool.submit(self.fetch_page, chapter.ref, page, textonly) for page in range(2, known+1) ]
+                scheduled.append((chapter.index, first, rest))
+
+            for chapter, first, rest in scheduled:
+                paras, count, extra = first.result()
+                story.set_page_count(chapter, count)
+                yield chapter, 1, paras
+                for page, future in enumerate(rest + extra, 2):
+                    if page > count:
+                        # the chapter has shrunk since its page count was recorded
+                        future.cancel()
+                        continue
+                    paras, _ = future.result()
+                    yield chapter, page, paras
+
+    def current_chapter(self):
+        """Returns the handle of the chapter the story's cursor is on."""
+        return self.story.get_chapters()[self.story.chapter-1]
+
+    def _chapter_html(self, chapter, pages):
+        """Formats the fetched pages of a chapter as HTML."""
+        result = [ f"<h1>Chapter {chapter}</h1>\n" ]
+        for page, paras in pages:
+            otxt = "".join(f"<p>{p}</p>\n" for p in paras)
+            result.append(f"<h2>Page {page}</h2>\n{otxt}\n")
+        result.append("\n")
+        return "".join(result)
 
     def get_story_html(self, chapter):
-        """Fetches the HTML content of a story chapter."""
-        result = f"<h1>Chapter {chapter}</h1>\n"
-        for i in range(100): # limit to 100 pages per chapter in case of bugs
-            try:
-                page = i+1
-                otxt = ""
-                for p in self.fetch_story_content(self.story.chapter_ref, page, textonly=False):
-                    otxt += f"<p>{p}</p>\n"
-                result += f"<h2>Page {page}</h2>\n{otxt}\n"
-            except:
-                break
-        result += "\n"
-        return result
+        """Fetches the HTML content of the current story chapter."""
+        pages = [ (page, paras) for _, page, paras in self.fetch_chapter_pages(self.story, [self.current_chapter()]) ]
+        return self._chapter_html(chapter, pages)
+
+    def fetch_story(self):
+        """
+        Fetches every page of the story, all chapters concurrently.  The pages are kept, so the
+        HTML and the plain text of the story are both produced from a single fetch.
+        Returns:
+            List of (chapter, page, paragraphs) tuples in document order.
+        """
+        if self._pages is None:
+            self._pages = list(self.fetch_chapter_pages(self.story))
+        return self._pages
 
     def get_full_story_html(self):
-        """Fetches the full story as HTML."""
-        body = ""
-        for i in range(len(self.story.story_ref)):
-            body += self.get_story_html(i)
-            self.story.next_chapter()
-        return body
+        """Returns the full story as HTML."""
+        chapters = [ [] for _ in self.story.chapters ]
+        for chapter, page, paras in self.fetch_story():
+            chapters[chapter].append((page, paras))
+        return "".join(self._chapter_html(i+1, pages) for i, pages in enumerate(chapters))
 
     def get_story_text(self, story, page=1):
         """
@@ -105,84 +256,98 @@ class Litero:
         Returns:
             The full story in SSML format
         """
-        ssml="<speak>\n"
-        for i in range(100):
-            try:
-                if i > 0:
-                    ssml += f'<break time="1500ms">\n'
-                page = i+1
-                ssml += f'Page {page}<break time="1000ms">\n'
-                for p in self.get_story(story, page):
-                    ssml += p
-                    ssml += f'<p>\n'
-            except:
-                break
-        ssml += "</speak>\n"
-        return ssml
-
-    def get_full_story_txt(self, story : Story):
+        ssml = [ "<speak>\n" ]
+        for _, page, paras in self.fetch_chapter_pages(story, [story.get_chapters()[story.chapter-1]], textonly=True):
+            if page > 1:
+                ssml.append(f'<break time="1500ms">\n')
+            ssml.append(f'Page {page}<break time="1000ms">\n')
+            for p in paras:
+                ssml.append(p)
+                ssml.append(f'<p>\n')
+        ssml.append("</speak>\n")
+        return "".join(ssml)
+
+    def story_paragraphs(self, story : Story):
+        """
+        Fetches all chapters of a story as a stream of plain text paragraphs, with a heading
+        paragraph before each page (and each chapter when there are several).
+        """
+        chapters = len(story.chapters)
+        last_chapter = None
+        pages = self.fetch_story() if story is self.story else self.fetch_chapter_pages(story)
+        for chapter, page, paras in pages:
+            if not paras:
+                continue
+            if chapter != last_chapter and chapters > 1:
+                yield f'Chapter {chapter+1}'
+                last_chapter = chapter
+            yield f'Page {page}'
+            for p in paras:
+                yield p.text
+
+    def get_full_story_txt(self, story : Story, max_chars=POLLY_MAX_BILLED):
         """
         Fetches the full story as plain text, split into parts to fit Polly limits.
         
         Args:
             story: The Story object representing the story to fetch.
+            max_chars: Maximum number of characters per part.
         Yields:
             Parts of the story as plain text, each part fitting within Polly's limits.
         """
-        fulltext=""
-        for i in range(100):
-            try:
-                if i > 0:
-                    fulltext += f'\n\n'
-                page = i+1
-                header = f'Page {page}\n\n'
-                for p in self.get_story_text(story.chapter_ref, page):
-                    if not header is None:
-                        fulltext += header
-                        header = None
-                    fulltext += p
-                    fulltext += f'\n\n'
-                if len(fulltext)>80000:
-                    yield fulltext
-                    fulltext=""
-            except Exception as ex:
-                print(ex)
-                break
-        fulltext += "\n"
-        yield fulltext
-
-    def get_story_file(self, story : Story):
-        #print("get_story_file()")
-
-        ssml = story.get_title() + "\n\n"
-        eof = False
-        with open(story.chapter_ref, "rt") as f:
-            while not eof:
-                ll = f.readline()
-                #print(f"ll={ll}")
-                if not ll:
-                    eof=True
-                else:
-                    ssml += ll
-                if (len(ssml)>80000 and ll=="\n") or eof:
-                    print(f"get_story_file -> [{len(ssml)}]{ssml[0:60]}... ")
-                    yield ssml
-                    ssml = ""
-
-
-    def read(self):
+        return pack_parts(self.story_paragraphs(story), max_billed=max_chars)
+
+    def file_paragraphs(self, story : Story):
+        """Reads the local text files of a story as a stream of paragraphs, starting with the title."""
+        yield story.get_title()
+        for chapter in story.get_chapters():
+            with open(chapter.ref, "rt") as f:
+                yield from text_file_paragraphs(f)
+
+    def get_story_file(self, story : Story, max_chars=POLLY_MAX_BILLED):
+        """
+        Reads a story from local text files, split into parts to fit Polly limits.
+
+        Args:
+            story: The Story object whose chapters are local text files.
+            max_chars: Maximum number of characters per part.
+        Yields:
+            Parts of the story as plain text.
+        """
+        for part in pack_parts(self.file_paragraphs(story), max_billed=max_chars):
+            print(f"get_story_file -> [{len(part)}]{part[0:60]}... ")
+            yield part
+
+
+    def read(self, secret=None):
+        """Submits the Polly tasks reading the story."""
         print('Reading')
-        self.polly.read()
-        sleep(5)
+        self.polly.read(secret)
+
+    def is_downloaded(self):
+        """True if the audio of the whole story has been downloaded."""
+        return self.polly.is_downloaded()
 
-    def download(self):
+    def download(self, timeout=900):
+        """
+        Waits for the Polly tasks and downloads each part as soon as it is ready.
+        Returns False if the tasks did not finish within timeout seconds.
+        """
         print(f'Downloading story {self.story.chapter_ref}')
-        count = 0
-        while self.polly.download():
-            print('...')
-            sleep(5)
-            count += 1
-            if count >= 30:
-                print("Timed out")
-                return False
+        if not self.polly.tasks:
+            # read before task IDs were recorded: poll the S3 listing instead
+            count = 0
+            while self.polly.download():
+                print('...')
+                sleep(5)
+                count += 1
+                if count >= 30:
+                    print("Timed out")
+                    return False
+            return True
+        try:
+            self.polly.download_tasks(timeout=timeout)
+        except TimeoutError as ex:
+            print(f"Timed out: {ex}")
+            return False
         return True
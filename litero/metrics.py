@@ -0,0 +1,225 @@
+import atexit
+import glob
+import json
+import multiprocessing
+import os
+import threading
+import time
+from contextlib import nullcontext
+
+ENV = "LITERO_METRICS"
+
+_NO_TIMER = nullcontext()
+
+
+class JsonLinesSink:
+    """Appends every observation as one JSON object per line: {"t", "metric", "value", <labels>}."""
+    def __init__(self, path):
+        self.path = path
+
+    def write(self, events, counters, timings):
+        if not events:
+            return
+        lines = "".join(json.dumps(dict(labels, t=round(t, 3), metric=name, value=value)) + "\n"
+                        for t, name, value, labels in events)
+        # one append per flush, so the lines of concurrent processes do not interleave
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path, "at") as f:
+            f.write(lines)
+
+
+class PrometheusSink:
+    """
+    Writes the totals in the Prometheus text format, for the node exporter's textfile collector.
+    The file is replaced atomically on every flush.  Timings are exported as summaries
+    (<name>_count, <name>_sum) plus a <name>_max gauge.  Each process writes its own totals:
+    in a worker process the file name gets the process name as a suffix, and every series has a
+    process label ("main" or the worker's name), so the files never hold the same series.
+    """
+    def __init__(self, path):
+        self.path = path
+
+    def process_name(self):
+        # decided on writing: a spawned worker only knows it is one after importing its modules
+        if multiprocessing.parent_process() is None:
+            return "main"
+        return multiprocessing.current_process().name
+
+    def process_path(self):
+        name = self.process_name()
+        return self.path if name == "main" else f"{os.path.splitext(self.path)[0]}-{name}.prom"
+
+    def worker_paths(self):
+        """Returns the files written by the worker processes of this or earlier runs."""
+        return glob.glob(glob.escape(os.path.splitext(self.path)[0]) + "-*.prom")
+
+    def write(self, events, counters, timings):
+        process = ('process', self.process_name())
+        labelled = lambda l: format_labels(tuple(sorted(l + (process,))))
+        lines = []
+        for name in sorted({ n for n, _ in counters }):
+            lines.append(f"# TYPE {name} counter")
+            lines.extend(f"{name}{labelled(l)} {v:g}" for (n, l), v in sorted(counters.items()) if n == name)
+        for name in sorted({ n for n, _ in timings }):
+            lines.append(f"# TYPE {name} summary")
+            for (n, l), (count, total, peak) in sorted(timings.items()):
+                if n == name:
+                    lines.append(f"{name}_count{labelled(l)} {count}")
+                    lines.append(f"{name}_sum{labelled(l)} {total:g}")
+            lines.append(f"# TYPE {name}_max gauge")
+            lines.extend(f"{name}_max{labelled(l)} {t[2]:g}" for (n, l), t in sorted(timings.items()) if n == name)
+        path = self.process_path()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path + ".tmp", "wt") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}"
+
+def make_sink(path):
+    """Returns the sink for a path: Prometheus text for *.prom, JSON lines otherwise."""
+    return PrometheusSink(path) if path.endswith(".prom") else JsonLinesSink(path)
+
+
+class Metrics:
+    """
+    Counters and timings of the stages of a batch, with labels, kept in memory and flushed to a sink.
+
+    count() adds to a counter, observe() records a duration (or any other value summarised as
+    count/sum/max), and timer() observes the time spent in a with block.  Totals are kept per
+    (name, labels); keep labels few-valued (a stage, a status) so the totals stay small.  The
+    sink is written every flush_interval seconds, on flush() and at exit.  A disabled instance
+    records nothing, and its timer() is a shared no-op context.  Safe to share between threads.
+    """
+    def __init__(self, sink=None, enabled=True, flush_interval=10.0):
+        self.sink = sink
+        self.enabled = enabled
+        self.flush_interval = flush_interval
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timings = {}
+        self.events = []
+        self.last_flush = time.monotonic()
+
+    def __repr__(self):
+        return f"Metrics({self.sink.path if self.sink else None}, enabled={self.enabled})"
+
+    def _record(self, name, value, labels, timing):
+        key = (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+        with self.lock:
+            if timing:
+                count, total, peak = self.timings.get(key, (0, 0.0, 0.0))
+                self.timings[key] = (count + 1, total + value, max(peak, value))
+            else:
+                self.counters[key] = self.counters.get(key, 0) + value
+            if self.sink is not None:
+                self.events.append((time.time(), name, value, labels))
+            due = time.monotonic() - self.last_flush > self.flush_interval
+        if due:
+            self.flush()
+
+    def count(self, name, value=1, **labels):
+        """Adds value to a counter."""
+        if self.enabled:
+            self._record(name, value, labels, False)
+
+    def observe(self, name, value, **labels):
+        """Records one duration, in seconds, or other measurement."""
+        if self.enabled:
+            self._record(name, value, labels, True)
+
+    def timer(self, name, **labels):
+        """Returns a context manager observing the seconds spent inside it."""
+        if not self.enabled:
+            return _NO_TIMER
+        return _Timer(self, name, labels)
+
+    def flush(self):
+        """Writes the pending observations and the totals to the sink."""
+        with self.lock:
+            self.last_flush = time.monotonic()
+            if self.sink is None:
+                return
+            events, self.events = self.events, []
+            counters, timings = dict(self.counters), dict(self.timings)
+        self.sink.write(events, counters, timings)
+
+    def summary(self):
+        """Returns the totals as a table, one line per metric and labels."""
+        with self.lock:
+            counters, timings = dict(self.counters), dict(self.timings)
+        lines = []
+        for (name, labels), (count, total, peak) in sorted(timings.items()):
+            lines.append(f"{name}{format_labels(labels)}: {count} x, {total:.2f}s total, {total/count:.3f}s mean, {peak:.3f}s max")
+        for (name, labels), value in sorted(counters.items()):
+            lines.append(f"{name}{format_labels(labels)}: {value:g}")
+        return "\n".join(lines)
+
+
+class _Timer:
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+
+def from_env():
+    """
+    Creates the process metrics from the LITERO_METRICS environment variable: the path of the
+    sink, or unset (or 'off') to disable them.  Worker processes inherit the variable, so they
+    report to the same place.
+    """
+    path = os.environ.get(ENV, "")
+    if path in ("", "off"):
+        return Metrics(enabled=False)
+    return Metrics(make_sink(path))
+
+_metrics = from_env()
+atexit.register(lambda: _metrics.flush())
+
+def configure(path):
+    """
+    Sends the metrics of this process, and of the worker processes it starts from now on, to path;
+    None or 'off' turns them off.
+    """
+    global _metrics
+    _metrics.flush()
+    os.environ[ENV] = path or "off"
+    _metrics = from_env()
+    if isinstance(_metrics.sink, PrometheusSink) and multiprocessing.parent_process() is None:
+        # the files of an earlier run's workers would be scraped along with this run's
+        for stale in _metrics.sink.worker_paths():
+            os.remove(stale)
+    return _metrics
+
+def enabled():
+    """True unless the metrics are off."""
+    return _metrics.enabled
+
+def count(name, value=1, **labels):
+    _metrics.count(name, value, **labels)
+
+def observe(name, value, **labels):
+    _metrics.observe(name, value, **labels)
+
+def timer(name, **labels):
+    return _metrics.timer(name, **labels)
+
+def flush():
+    _metrics.flush()
+
+def summary():
+    return _metrics.summary()
@@ -0,0 +1,98 @@
+import re
+
+POLLY_MAX_BILLED = 100000  # billed characters per speech synthesis task
+POLLY_MAX_TOTAL = 200000   # total characters per speech synthesis task, SSML markup included
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+WORD_GAP = re.compile(r'\s+')
+SSML_TAG = re.compile('<[^>]*>')
+
+
+def billed_length(text, ssml=False):
+    """Returns the number of characters Polly bills for text; SSML tags are not billed."""
+    if ssml:
+        return len(text) - sum(len(m) for m in SSML_TAG.findall(text))
+    return len(text)
+
+def _split(text, pattern, limit):
+    """Splits text at the matches of pattern into pieces of at most limit characters where possible."""
+    pieces = []
+    start = 0
+    cut = 0
+    for m in pattern.finditer(text):
+        if m.start() - start > limit and cut > start:
+            pieces.append(text[start:cut])
+            start = cut_next
+        cut, cut_next = m.start(), m.end()
+    if len(text) - start > limit and cut > start:
+        pieces.append(text[start:cut])
+        start = cut_next
+    pieces.append(text[start:])
+    return pieces
+
+def split_paragraph(text, limit):
+    """
+    Splits a paragraph that is longer than limit at sentence boundaries, and a sentence that is
+    still too long at word boundaries.  A single word longer than limit is cut as a last resort.
+    """
+    if len(text) <= limit:
+        return [ text ]
+    result = []
+    for sentences in _split(text, SENTENCE_END, limit):
+        if len(sentences) <= limit:
+            result.append(sentences)
+            continue
+        for words in _split(sentences, WORD_GAP, limit):
+            result.extend(words[i:i+limit] for i in range(0, len(words), limit))
+    return result
+
+def pack_parts(paragraphs, max_billed=POLLY_MAX_BILLED, max_total=POLLY_MAX_TOTAL, ssml=False, separator="\n\n"):
+    """
+    Packs a stream of paragraphs into as few parts as possible for speech synthesis.
+
+    Paragraphs are joined with separator and a part is emitted just before the next paragraph
+    would push it over either limit, so parts only break between paragraphs.  A paragraph that
+    does not fit in a part on its own is split at sentence boundaries.  Paragraphs are buffered
+    in a list and joined once per part, so the cost is linear in the length of the story.
+
+    Args:
+        paragraphs: Iterable of paragraph strings from any source, e.g. several chapters.
+        max_billed: Maximum billed characters per part.
+        max_total: Maximum total characters per part.
+        ssml: True if the paragraphs are SSML, whose tags count towards max_total only.
+        separator: String placed between paragraphs.
+    Yields:
+        Parts of the text.
+    """
+    limit = min(max_billed, max_total)
+    buf = []
+    billed = 0
+    total = 0
+    for para in paragraphs:
+        para = para.strip()
+        if not para:
+            continue
+        for piece in split_paragraph(para, limit):
+            piece_billed = billed_length(piece, ssml)
+            sep = len(separator) if buf else 0
+            if buf and (billed + sep + piece_billed > max_billed or total + sep + len(piece) > max_total):
+                yield separator.join(buf)
+                buf = []
+                billed = total = sep = 0
+            buf.append(piece)
+            billed += sep + piece_billed
+            total += sep + len(piece)
+    if buf:
+        yield separator.join(buf)
+
+def text_file_paragraphs(f):
+    """Reads a plain text file as a stream of paragraphs separated by blank lines."""
+    lines = []
+    for ll in f:
+        if ll.strip():
+            lines.append(ll)
+        elif lines:
+            yield "".join(lines)
+            lines = []
+    if lines:
+        yield "".join(lines)
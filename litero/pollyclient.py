@@ -1,14 +1,57 @@
 import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+import hashlib
+import json
 import os
+import shutil
 import re
+import threading
+import time
 import keyring
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse
 from .story import Story
+from .synthcache import SynthesisCache
+from . import metrics
+from botocore.exceptions import ClientError
 from typing import List
-from multicloud.backend.secret import Secret 
+from multicloud.backend.secret import Secret
+
+
+BUCKET = 'frubious-bandersnatch'
+
+class RateLimiter:
+    """Spaces out calls shared between threads to at most `rate` per second."""
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval
+        if start > now:
+            time.sleep(start - now)
 
 
 class PollyClient:
-    def __init__(self, story : Story, story_text : List[str], voice : str = None):
+    def __init__(self, story : Story, story_text : List[str], voice : str = None,
+                 polly = None, s3 = None, max_workers : int = 4, rate : float = 5.0, cache : SynthesisCache = None,
+                 limiter : RateLimiter = None):
+        """
+        Args:
+            story: The story being read.
+            story_text: The parts of the story text, one Polly task each.
+            voice: Polly voice.
+            polly, s3: boto3 clients (or compatible stubs); created from the stored credentials when not given.
+            max_workers: Number of tasks submitted concurrently.
+            rate: Maximum Polly API calls per second.
+            cache: Optional synthesis cache; parts read before with the same settings are not sent to Polly again.
+            limiter: Rate limiter shared with other clients; replaces `rate` when given.
+        """
         language = 'en-GB'
         if voice is None:
             voice = 'Brian'
@@ -34,75 +77,346 @@ class PollyClient:
         self.story = story
         self.voice = voice
         self.language = language
+        self.engine = 'standard'  #neural
+        self.sample_rate = '22050'
+        self.cache = cache
         self.parts = 0
+        self.tasks = []
+        self.polly = polly
+        self.s3 = s3
+        self.max_workers = max_workers
+        self.limiter = limiter if limiter is not None else RateLimiter(rate)
+        self.lock = threading.Lock()
+        # parts of a long story run to tens of MB: fetch large objects in 8MB ranges, 4 at a time
+        self.transfer = TransferConfig(multipart_threshold=8*1024*1024, multipart_chunksize=8*1024*1024,
+                                       max_concurrency=4, use_threads=True)
+        self.load_tasks()
+
+    def connect(self, secret: Secret = None):
+        """Creates the Polly and S3 clients that were not passed in, from a Secret or the keyring."""
+        if self.polly is not None and self.s3 is not None:
+            return
+        if secret is not None:
+            creds = secret.get()
+            assert 'access_id' in creds, "Secret must contain access_id"
+            assert 'secret_key' in creds, "Secret must contain secret_key"
+        else:
+            creds = { 'access_id': keyring.get_password('aws', 'access_id'),
+                      'secret_key': keyring.get_password('aws', 'secret_key') }
+        config = Config(retries={ 'max_attempts': 10, 'mode': 'adaptive' })
+        if self.polly is None:
+            self.polly = boto3.client('polly',
+                aws_access_key_id=creds['access_id'],
+                aws_secret_access_key=creds['secret_key'],
+                region_name='us-west-2',
+                config=config)
+        if self.s3 is None:
+            self.s3 = boto3.client('s3',
+                aws_access_key_id=creds['access_id'],
+                aws_secret_access_key=creds['secret_key'],
+                config=config.merge(Config(max_pool_connections=self.max_workers * 4 + 4)))
+
+    def load_tasks(self):
+        """Loads the tasks recorded by an earlier read(); returns True if there are any."""
+        path = self.story.get_tasks_path()
+        if not os.path.isfile(path):
+            return False
+        with open(path, "rt") as f:
+            record = json.load(f)
+        if record.get('voice') != self.voice:
+            print(f"Recorded tasks are for voice {record.get('voice')}, not {self.voice}: not used")
+            return False
+        self.tasks = record['tasks']
+        self.parts = record['parts']
+        return True
+
+    def save_tasks(self):
+        """Records the task IDs and their state, so a later run can wait for and download them."""
+        path = self.story.get_tasks_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with self.lock:
+            record = { 'voice': self.voice, 'language': self.language, 'parts': self.parts, 'tasks': self.tasks }
+            with open(path + ".tmp", "wt") as f:
+                json.dump(record, f, indent=1)
+            os.replace(path + ".tmp", path)
+
+    def _submit(self, part, txt):
+        self.limiter.wait()
+        r = self.polly.start_speech_synthesis_task(
+            Engine=self.engine,
+            LanguageCode=self.language,
+            OutputFormat='mp3',
+            OutputS3BucketName=BUCKET,
+            OutputS3KeyPrefix=self.story.get_s3_path(part),
+            SampleRate=self.sample_rate,
+            # SnsTopicArn
+            # SpeechMarkTypes='ssml',
+            Text=txt,
+            TextType='text',
+            VoiceId=self.voice
+        )
+        task = r['SynthesisTask']
+        print('part', part, 'length', len(txt), 'task', task['TaskId'])
+        metrics.count('litero_polly_parts_total', source='polly')
+        metrics.count('litero_polly_chars_total', len(txt))
+        return { 'part': part, 'task_id': task['TaskId'], 'status': task['TaskStatus'],
+                 'output_uri': task.get('OutputUri'), 'downloaded': False, 'submitted': time.time() }
+
+    def _reuse(self, part, digest):
+        """Returns a completed task for a part whose audio is in the synthesis cache, or None."""
+        entry = self.cache.lookup(digest)
+        if entry is None:
+            return None
+        task = { 'part': part, 'task_id': None, 'status': 'completed', 'output_uri': None,
+                 's3_key': entry.get('s3_key'), 'local_path': entry.get('local_path'),
+                 'size': entry.get('size'), 'md5': entry.get('md5'), 'downloaded': False, 'hash': digest }
+        if SynthesisCache.local_audio(task):
+            print('part', part, 'cached', task['local_path'])
+            metrics.count('litero_polly_parts_total', source='cache')
+            return task
+        if task['s3_key']:
+            try:
+                self.s3.head_object(Bucket=BUCKET, Key=task['s3_key'])
+                print('part', part, 'cached', task['s3_key'])
+                metrics.count('litero_polly_parts_total', source='cache')
+                return task
+            except ClientError:
+                pass
+        self.cache.forget(digest)
+        return None
+
+    def _read_part(self, part, txt):
+        digest = self.part_digest(txt)
+        task = self._reuse(part, digest) if self.cache is not None else None
+        if task is None:
+            task = self._submit(part, txt)
+            task['hash'] = digest
+        return task
 
+    def part_digest(self, txt):
+        """Returns the digest of a part's text and the settings it is read with, recorded with its task."""
+        return SynthesisCache.key(txt, self.voice, self.language, self.engine, self.sample_rate)
 
+    def text_parts(self):
+        """Returns the parts of the story text as a list; a generator is only consumed once."""
+        if not isinstance(self.story_text, list):
+            self.story_text = list(self.story_text)
+        return self.story_text
+
+    def stale_parts(self):
+        """
+        Returns the numbers of the parts that need a new task: those without a recorded task, or
+        whose task failed, or was submitted for a different text.  All of them when the text is
+        split into a different number of parts.  Tasks recorded without a digest, before digests
+        were kept, are taken to match.
+        """
+        parts = self.text_parts()
+        if self.parts != len(parts):
+            return list(range(1, len(parts)+1))
+        current = { task['part'] for task in self.tasks
+                    if task['status'] != 'failed' and task.get('hash') in (None, self.part_digest(parts[task['part']-1])) }
+        return [ part for part in range(1, len(parts)+1) if part not in current ]
 
-    def read(self, secret: Secret):
+    def read(self, secret: Secret = None):
+        """
+        Submits one speech synthesis task per part of the story text, up to max_workers at a time.
+        Parts found in the synthesis cache reuse the audio already produced for them instead.
+
+        Each task is recorded with the digest of its text as soon as it is submitted, so if a
+        submission fails the tasks already started are kept: the next read() only submits the
+        parts that have no task, whose task failed, or whose text has changed (see stale_parts()).
+        """
         print("read()")
-        creds = secret.get()
-        assert 'access_id' in creds, "Secret must contain access_id"
-        assert 'secret_key' in creds, "Secret must contain secret_key"
-
-        polly = boto3.client('polly',
-             aws_access_key_id=creds['access_id'],
-             aws_secret_access_key=creds['secret_key'],
-             region_name='us-west-2')
-        
-        res=[]
-        part = 0
-        for i,txt in enumerate(self.story_text):
-            part += 1
-            r = polly.start_speech_synthesis_task(
-                Engine='standard',  #neural
-                LanguageCode=self.language,
-                OutputFormat='mp3',
-                OutputS3BucketName='frubious-bandersnatch',
-                OutputS3KeyPrefix=self.story.get_s3_path(part),
-                SampleRate='22050',
-                # SnsTopicArn
-                # SpeechMarkTypes='ssml',
-                Text=txt,
-                TextType='text',
-                VoiceId=self.voice
-            )
-            #print(f"part {i} len {len(txt)}") # result {r}")
-            print('part',i,'length',len(txt))
+        self.connect(secret)
+        parts = self.text_parts()
+        with self.lock:
+            todo = self.stale_parts()
+            self.parts = len(parts)
+            self.tasks = [ task for task in self.tasks if task['part'] not in todo ]
 
+        def submit(part):
+            task = self._read_part(part, parts[part-1])
+            with self.lock:
+                self.tasks.append(task)
+                self.tasks.sort(key=lambda task: task['part'])
+            self.save_tasks()
+
+        with metrics.timer('litero_polly_read_seconds'), ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for _ in pool.map(submit, todo):
+                pass
+        self.save_tasks()
+
+    def wait(self, timeout=900, initial_delay=2, max_delay=30):
+        """
+        Polls the recorded tasks with exponential backoff and yields each one as soon as it has completed.
+        Raises TimeoutError if tasks are still running after `timeout` seconds, or an exception if a task failed.
+        """
+        self.connect()
+        pending = []
+        for task in self.tasks:
+            if task['status'] == 'completed':
+                yield task
+            else:
+                pending.append(task)
+        deadline = time.time() + timeout
+        delay = initial_delay
+        while pending:
+            for task in list(pending):
+                self.limiter.wait()
+                r = self.polly.get_speech_synthesis_task(TaskId=task['task_id'])['SynthesisTask']
+                task['status'] = r['TaskStatus']
+                if task['status'] == 'completed':
+                    task['output_uri'] = r['OutputUri']
+                    pending.remove(task)
+                    if 'submitted' in task:
+                        # from submission, which may have been in an earlier run
+                        metrics.observe('litero_polly_task_wait_seconds', time.time() - task['submitted'])
+                    if self.cache is not None and 'hash' in task:
+                        self.cache.store(task['hash'], s3_key=self.output_key(task))
+                    self.save_tasks()
+                    yield task
+                elif task['status'] == 'failed':
+                    self.save_tasks()
+                    metrics.count('litero_polly_tasks_failed_total')
+                    raise Exception(f"Polly task {task['task_id']} for part {task['part']} failed: {r.get('TaskStatusReason')}")
+            if pending:
+                if time.time() + delay > deadline:
+                    raise TimeoutError(f"{len(pending)} of {self.parts} parts still in progress")
+                time.sleep(delay)
+                delay = min(delay * 2, max_delay)
+
+    def output_key(self, task):
+        """Returns the S3 key of the audio written by a completed task."""
+        if task.get('s3_key'):
+            return task['s3_key']
+        uri = urlparse(task['output_uri'])
+        path = uri.path.lstrip('/')
+        if not uri.netloc.startswith(BUCKET + '.'):
+            # path-style URL: https://s3.<region>.amazonaws.com/<bucket>/<key>
+            path = path.split('/', 1)[1]
+        return path
+
+    def fetch_object(self, key, fname, size=None, etag=None):
+        """
+        Downloads one S3 object to fname, unless the local file already has the same size and ETag.
+        The object is written to a temporary file that is renamed into place once complete, so an
+        interrupted download never leaves a truncated file behind.
+        Returns True if the object was downloaded, False if the local copy was up to date.
+        """
+        if size is None or etag is None:
+            head = self.s3.head_object(Bucket=BUCKET, Key=key)
+            size, etag = head['ContentLength'], head['ETag']
+        if same_file(fname, size, etag):
+            print(f"Up to date '{key}'")
+            return False
+        print(f"Downloading '{key}'")
+        with metrics.timer('litero_polly_download_seconds'):
+            self.s3.download_file(BUCKET, key, fname + ".tmp", Config=self.transfer)
+        os.replace(fname + ".tmp", fname)
+        metrics.count('litero_polly_download_bytes_total', size)
+        return True
+
+    def download_part(self, task, basedir="."):
+        """Downloads the audio of a completed task as part<n>.mp3 in the story's audio directory."""
+        destdir = self.story.get_audio_path()
+        os.makedirs(destdir, exist_ok=True)
+        fname = f"{destdir}/part{task['part']}.mp3"
+        # checked again: the cached file may have been overwritten by another part since
+        source = SynthesisCache.local_audio(task)
+        if source is None and not task.get('s3_key') and not task.get('output_uri'):
+            raise Exception(f"Cached audio of part {task['part']} has changed: {task['local_path']}")
+        if source:
+            if os.path.abspath(source) != os.path.abspath(fname):
+                print(f"Copying cached '{source}'")
+                shutil.copyfile(source, fname + ".tmp")
+                os.replace(fname + ".tmp", fname)
+        else:
+            self.fetch_object(self.output_key(task), fname)
+        task['downloaded'] = True
+        if self.cache is not None and 'hash' in task:
+            self.cache.store(task['hash'], local_path=fname)
+        self.save_tasks()
+
+    def download_tasks(self, timeout=900):
+        """
+        Waits for the recorded tasks and downloads each part concurrently as soon as its task completes.
+        Raises TimeoutError if tasks are still running after `timeout` seconds.
+        """
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = [ pool.submit(self.download_part, task)
+                        for task in self.wait(timeout=timeout) if not task.get('downloaded') ]
+            for future in futures:
+                future.result()
+
+    def is_downloaded(self):
+        """True if the audio of every part is on disk."""
+        if self.tasks:
+            return all(task.get('downloaded') for task in self.tasks)
+        return os.path.isdir(self.story.get_audio_path())
+
+    def has_audio(self):
+        """True if audio of this story is on disk or in S3."""
+        if os.path.isdir(self.story.get_audio_path()):
+            return True
+        self.connect()
+        return bool(self.list_audio())
+
+    def list_audio(self):
+        """Lists all audio objects of this story in S3, following the listing across pages."""
+        paginator = self.s3.get_paginator('list_objects_v2')
+        objects = []
+        for page in paginator.paginate(Bucket=BUCKET, Prefix=self.story.get_s3_basepath()+"/", Delimiter='/'):
+            objects.extend(itm for itm in page.get('Contents', []) if itm['Key'] != "")
+        return objects
 
     def download(self, basedir="."):
         """
         Downloads the audio files for this story from S3, if they exist.
         Return True as long as the files are not yet ready. 
         Returns False if the files are present, in which case they are downloaded.
+
+        Used for stories read before task IDs were recorded; otherwise download_tasks() is used.
+        Each part may have been read more than once (part<n>.<task-id>.mp3): only its newest
+        object is downloaded.  Files already on disk with the same size and ETag are skipped.
         """
         try_again = True
-        s3 = boto3.client('s3',
-             aws_access_key_id=keyring.get_password('aws','access_id'),
-             aws_secret_access_key=keyring.get_password('aws', 'secret_key'))
-        res = s3.list_objects_v2(
-            Bucket='frubious-bandersnatch',
-            Prefix=self.story.get_s3_basepath()+"/",
-            Delimiter='/'
-        )
-        print(res)
-        if not 'Contents' in res:
+        self.connect()
+        newest = {}
+        for itm in self.list_audio():
+            part = os.path.basename(itm['Key']).split('.')[0]
+            if part not in newest or itm['LastModified'] > newest[part]['LastModified']:
+                newest[part] = itm
+        if not newest:
             return try_again
-        if len(res['Contents']) < self.parts:
+        if len(newest) < self.parts:
             return try_again
 
         # All parts are present, download them
         try_again = False
         destdir = self.story.get_audio_path()
-        if not os.path.isdir(destdir):
-            os.mkdir(destdir)
-
-        for itm in res['Contents']:
-            if itm['Key'] == "": continue
-            key = itm['Key']
-            print(f"Downloading '{key}'")
-            fname = os.path.basename(key).split('.')
-            fname = f"{fname[0]}.mp3"
-            s3.download_file('frubious-bandersnatch', key, f"{destdir}/{fname}")
-
-        return try_again
\ No newline at end of file
+        os.makedirs(destdir, exist_ok=True)
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = []
+            for part, itm in newest.items():
+                fname = f"{destdir}/{part}.mp3"
+                futures.append(pool.submit(self.fetch_object, itm['Key'], fname, itm['Size'], itm['ETag']))
+            for future in futures:
+                future.result()
+
+        return try_again
+
+
+def same_file(path, size, etag):
+    """True if the local file at path has the given size and S3 ETag."""
+    if not os.path.isfile(path) or os.path.getsize(path) != size:
+        return False
+    etag = etag.strip('"')
+    if '-' in etag:
+        # multipart upload: the ETag is not the MD5 of the content, so the size has to do
+        return True
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            md5.update(block)
+    return md5.hexdigest() == etag
@@ -0,0 +1,123 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from . import metrics
+
+
+def file_hash(path):
+    """Returns the SHA-256 of a file's content."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+class Publisher:
+    """
+    Copies the audio of stories to a published directory (e.g. a mounted web share), only
+    sending the files that differ from what is already there.
+
+    A destination file is up to date when it has the same size and mtime as its source (the
+    mtime is copied along with the content), or, with check='hash', the same content.  Files
+    are copied max_workers at a time, each to a temporary name in the destination directory
+    and renamed into place, so readers of the share never see a half-written mp3.  Every
+    published file is recorded in a local JSON file with its size, mtime, hash and time.
+    """
+    def __init__(self, dest_root, max_workers=4, check='mtime', record_path="./cache/published.json"):
+        """
+        Args:
+            dest_root: Directory the stories are published under, one subdirectory each.
+            max_workers: Number of files copied at a time.
+            check: 'mtime' compares size and mtime; 'hash' compares size and content.
+            record_path: JSON record of the published files; None keeps no record.
+        """
+        if check not in ('mtime', 'hash'):
+            raise ValueError(f"Unknown check {check}")
+        self.dest_root = dest_root
+        self.max_workers = max_workers
+        self.check = check
+        self.record_path = record_path
+        self.lock = threading.Lock()
+        self.published = {}
+        self.unsaved = False
+        if record_path and os.path.isfile(record_path):
+            with open(record_path, "rt") as f:
+                self.published = json.load(f)
+
+    def __repr__(self):
+        return f"Publisher({self.dest_root}, check={self.check})"
+
+    def up_to_date(self, src, dest, src_hash=None):
+        """True if dest already holds the content of src.  With check='hash', src_hash is the
+        hash of src if already known."""
+        try:
+            d = os.stat(dest)
+        except FileNotFoundError:
+            return False
+        s = os.stat(src)
+        if s.st_size != d.st_size:
+            return False
+        if self.check == 'hash':
+            return (src_hash or file_hash(src)) == file_hash(dest)
+        # whole seconds: network shares often keep coarser timestamps than the local disk
+        return int(s.st_mtime) == int(d.st_mtime)
+
+    def copy(self, src, dest):
+        """Copies src to dest through a temporary file renamed into place.  Returns True if copied."""
+        src_hash = file_hash(src) if self.check == 'hash' else None
+        if self.up_to_date(src, dest, src_hash):
+            return False
+        tmp = os.path.join(os.path.dirname(dest), f".{os.path.basename(dest)}.tmp")
+        with metrics.timer('litero_publish_copy_seconds'):
+            try:
+                shutil.copy2(src, tmp)
+                os.replace(tmp, dest)
+            except BaseException:
+                if os.path.exists(tmp):
+                    os.remove(tmp)
+                raise
+        st = os.stat(src)
+        metrics.count('litero_publish_bytes_total', st.st_size)
+        with self.lock:
+            self.published[dest] = { 'source': src, 'size': st.st_size, 'mtime': st.st_mtime,
+                                     'sha256': src_hash, 'published': time.time() }
+            self.unsaved = True
+        return True
+
+    def publish(self, src_dir, name):
+        """
+        Publishes the files under src_dir, recursively, as dest_root/name.
+        Returns (copied, unchanged), the number of files of each.
+        """
+        dest_dir = os.path.join(self.dest_root, name)
+        pairs = []
+        for root, _, files in os.walk(src_dir):
+            target = os.path.join(dest_dir, os.path.relpath(root, src_dir))
+            os.makedirs(target, exist_ok=True)
+            pairs.extend((os.path.join(root, f), os.path.normpath(os.path.join(target, f))) for f in sorted(files))
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+                copied = sum(pool.map(lambda pair: self.copy(*pair), pairs))
+        finally:
+            # the files copied before a failure are recorded too
+            if self.unsaved:
+                self.save()
+        metrics.count('litero_publish_files_total', copied, outcome='copied')
+        metrics.count('litero_publish_files_total', len(pairs) - copied, outcome='unchanged')
+        print(f"Published {src_dir} to {dest_dir}: {copied} copied, {len(pairs) - copied} unchanged")
+        return copied, len(pairs) - copied
+
+    def save(self):
+        if not self.record_path:
+            return
+        with self.lock:
+            os.makedirs(os.path.dirname(self.record_path) or ".", exist_ok=True)
+            with open(self.record_path + ".tmp", "wt") as f:
+                json.dump(self.published, f, indent=1)
+            os.replace(self.record_path + ".tmp", self.record_path)
+            self.unsaved = False
@@ -1,12 +1,68 @@
+import json
 import os
 import re
 from enum import Enum
 import yaml
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 class StoryRefType(Enum):
     LOCALFILE = 1
     LITERO = 2
 
+def ref_type(chapter_ref):
+    """Returns the StoryRefType of a chapter reference."""
+    if chapter_ref.endswith(".txt"):
+        return StoryRefType.LOCALFILE
+    else:
+        return StoryRefType.LITERO
+
+def normalize_title(chapter_ref):
+    """Generates a title suitable for use in a file path or an S3 key from a chapter reference."""
+    path = re.sub(r".txt", "", os.path.basename(chapter_ref)).lower()
+    path = path.replace(' ', '-').lower()
+    path = re.sub(r"[^a-z0-9-]", "", path, count=1000)
+    return path
+
+class Chapter:
+    """
+    Immutable handle on one chapter of a story.  It carries everything a worker needs to process
+    the chapter, so chapters of one story can be fetched or read in parallel without sharing a cursor.
+    """
+    __slots__ = ('index', 'ref', 'reftype', 'slug', 'title', 'normalized_title', 'audio_path', 'html_path')
+
+    def __init__(self, story, index, ref):
+        """
+        Args:
+            story: The Story the chapter belongs to.
+            index: Position of the chapter in the story, counting from 0.
+            ref: URL, story slug or local file path of the chapter.
+        """
+        set_slot = super().__setattr__
+        set_slot('index', index)
+        set_slot('ref', ref)
+        set_slot('reftype', ref_type(ref))
+        set_slot('slug', ref.rstrip('/').split('/')[-1])
+        set_slot('title', story.get_title())
+        set_slot('normalized_title', story.get_normalized_title())
+        set_slot('audio_path', story.get_audio_path())
+        set_slot('html_path', story.get_html_path())
+
+    def __setattr__(self, name, value):
+        raise AttributeError(f"Chapter is immutable, cannot set {name}")
+
+    def __repr__(self):
+        return f"Chapter({self.normalized_title}, {self.index+1})"
+
+    @property
+    def number(self):
+        """The chapter number, counting from 1."""
+        return self.index + 1
+
+
 class Story:
     """
     Represents a story, complete with multiple chapters and pages.
@@ -30,101 +86,182 @@ class Story:
             self.story_ref = story_ref
         else:
             self.story_ref = { 'chapters': story_ref }
+        if isinstance(self.story_ref['chapters'], str):
+            self.story_ref['chapters'] = [ self.story_ref['chapters'] ]
+        self._normalized_title = normalize_title(self.story_ref['chapters'][0])
+        self._chapters = tuple(Chapter(self, i, ref) for i, ref in enumerate(self.story_ref['chapters']))
 
     def __repr__(self):
         return self.get_normalized_title()
 
     @property
     def reftype(self):
-        if self.chapter_ref.endswith(".txt"):
-            return StoryRefType.LOCALFILE
-        else:
-            return StoryRefType.LITERO
+        """The reference type of the current chapter."""
+        return self._chapters[self.chapter-1].reftype
 
     def next_chapter(self):
         """Advances to the next chapter."""
         self.chapter += 1
 
+    @property
+    def chapters(self):
+        """Returns the list of all chapter references (URLs or local file paths)."""
+        return self.story_ref["chapters"]
+
+    def get_chapters(self):
+        """Returns the immutable Chapter handles of all chapters, in order."""
+        return self._chapters
+
     @property
     def chapter_ref(self):
         """Returns the current chapter reference (URL or local file path)."""
-        return self.story_ref["chapters"][self.chapter-1]
+        return self._chapters[self.chapter-1].ref
 
-    def get_normalized_title(self):
-        """Generates a title suitable for use in a file path or an S3 key."""
-        #print(self.story_ref)
-        chapters = self.story_ref['chapters']
+    def get_page_count(self, chapter):
+        """Returns the page count of a chapter (counting from 0) recorded by an earlier fetch, or None."""
+        pages = self.story_ref.get('pages')
+        if pages and chapter < len(pages):
+            return pages[chapter]
+        return None
 
-        path = re.sub(r".txt", "", os.path.basename(chapters[0])).lower()
-        path = path.replace(' ', '-').lower()
-        path = re.sub(r"[^a-z0-9-]", "", path, count=1000)
-        return path
+    def set_page_count(self, chapter, count):
+        """Records the page count of a chapter (counting from 0) in the story metadata."""
+        pages = self.story_ref.setdefault('pages', [])
+        pages.extend([None] * (len(self.chapters) - len(pages)))
+        pages[chapter] = count
+
+    def get_normalized_title(self):
+        """Returns a title suitable for use in a file path or an S3 key."""
+        return self._normalized_title
 
     def get_audio_path(self):
         """Returns the local path to the audio files for this story."""
-        path = f"./audio/{self.get_normalized_title()}"
-        return path
+        return f"./audio/{self._normalized_title}"
 
     def get_html_path(self):
         """Returns the local path to the HTML file for this story."""
-        path = f"./html/{self.get_normalized_title()}.html"
-        return path
+        return f"./html/{self._normalized_title}.html"
+
+    def get_tasks_path(self):
+        """Returns the local path to the record of the Polly tasks reading this story."""
+        return f"./tasks/{self._normalized_title}.json"
 
     def get_s3_path(self, part):
         """Returns the S3 path to the audio files for a part of this story.  Parts are split by text length to fit Polly limits."""
-        path = f'{self.get_s3_basepath()}/part{part}'
-        return path
+        return f'{self.get_s3_basepath()}/part{part}'
 
     def get_s3_basepath(self):
         """Returns the S3 base path to the audio files for this story."""
-        path = f'lite/{self.get_normalized_title()}'
-        return path
+        return f'lite/{self._normalized_title}'
 
     def get_title(self):
         """Returns the story title in a human-readable format."""
         if 'title' in self.story_ref:
             title = self.story_ref['title']
         else:
-            title = self.get_normalized_title().replace('-', ' ').title()
+            title = self._normalized_title.replace('-', ' ').title()
         return title
 
 class Stories:
     """
     Represents a collection of stories.
+
+    The parsed catalog and its lookup indexes are cached in a JSON file next to the YAML file
+    and reused while the YAML file is unchanged, so opening a large catalog does not parse it
+    again.  An index file that cannot be read is rebuilt.  Story objects are only created when
+    they are asked for.
     """
+    INDEX_VERSION = 2
+
     def __init__(self, yaml_file):
         """
         Args:
             yaml_file: A path to a YAML file representing the collection of stories.
         """
-        with open(yaml_file, 'rt') as f:
-            self.stories_ref = yaml.safe_load(f)
-        self.stories_index = {
-            story.get_title(): story for story in self.get_stories()
-        }
+        self.yaml_file = yaml_file
+        self.index_file = yaml_file + ".idx"
+        index = self._load_index()
+        if index is None:
+            with open(yaml_file, 'rt') as f:
+                self.stories_ref = yaml.load(f, Loader=SafeLoader)
+            index = self._build_index()
+            self._save_index(index)
+        self.stories_ref = index['stories_ref']
+        self.title_index = index['title']
+        self.normalized_title_index = index['normalized_title']
+        self.chapter_index = index['chapter']
+        self.stories = [ None ] * len(self.stories_ref['stories'])
 
     def __repr__(self):
         return f"Stories({len(self.stories_ref['stories'])} stories)"
 
+    def _stamp(self):
+        st = os.stat(self.yaml_file)
+        return [ self.INDEX_VERSION, st.st_mtime_ns, st.st_size ]
+
+    def _load_index(self):
+        try:
+            with open(self.index_file, 'rt', encoding='utf-8') as f:
+                index = json.load(f)
+            if index.get('stamp') != self._stamp() or not all(k in index for k in ('stories_ref', 'title', 'normalized_title', 'chapter')):
+                return None
+        except Exception:
+            # missing, corrupt or from an older version: rebuilt from the catalog
+            return None
+        return index
+
+    def _build_index(self):
+        index = { 'stamp': self._stamp(), 'stories_ref': self.stories_ref,
+                  'title': {}, 'normalized_title': {}, 'chapter': {} }
+        for i, story_ref in enumerate(self.stories_ref['stories']):
+            story = Story(story_ref)
+            # the last of several stories with the same title wins, as it always has
+            index['title'][story.get_title()] = i
+            index['normalized_title'][story.get_normalized_title()] = i
+            for chapter_ref in story.chapters:
+                index['chapter'][chapter_ref] = i
+        return index
+
+    def _save_index(self, index):
+        try:
+            data = json.dumps(index)
+        except (TypeError, ValueError):
+            return # e.g. dates in the catalog: work without the cached index
+        try:
+            with open(self.index_file + ".tmp", 'wt', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(self.index_file + ".tmp", self.index_file)
+        except OSError:
+            pass # read-only catalog: work without the cached index
+
+    def _story(self, i):
+        if i is None:
+            return None
+        if self.stories[i] is None:
+            self.stories[i] = Story(self.stories_ref['stories'][i])
+        return self.stories[i]
+
     def get_stories(self):
         """Returns a list of Story objects."""
-        result = []
-        for story_ref in self.stories_ref['stories']:
-            story = Story(story_ref)
-            result.append(story)
-        return result
+        return [ self._story(i) for i in range(len(self.stories)) ]
     
     def get_story(self, title):
         """Returns a Story object by title."""
-        if title in self.stories_index:
-            return self.stories_index[title]
-        return None
+        return self._story(self.title_index.get(title))
+
+    def get_story_by_normalized_title(self, normalized_title):
+        """Returns a Story object by its normalized title, as used in file paths and S3 keys."""
+        return self._story(self.normalized_title_index.get(normalized_title))
+
+    def get_story_by_chapter(self, chapter_ref):
+        """Returns the Story object that has the given chapter URL or file path."""
+        return self._story(self.chapter_index.get(chapter_ref))
     
     def get_titles(self):
         """Returns a list of story titles."""
-        return list(self.stories_index.keys())
+        return list(self.title_index.keys())
     
     def dir(self):
         """Prints a list of stories."""
         for i, title in enumerate(self.get_titles()):
-            print(f"{i + 1:2d}: {title}")
\ No newline at end of file
+            print(f"{i + 1:2d}: {title}")
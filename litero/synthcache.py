@@ -0,0 +1,85 @@
+import hashlib
+import json
+import os
+import threading
+
+
+def file_md5(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024*1024), b""):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+class SynthesisCache:
+    """
+    Content-addressed index of synthesised audio.
+
+    Each entry is keyed by a hash of the text of a part and the settings it was read with, and
+    records where the audio produced for it is kept: the S3 key written by Polly and/or a local
+    file.  A local file may be overwritten later by another reading, so its size and MD5 are
+    recorded too and checked before it is reused (see local_audio()).  The index is a local
+    JSON file, so lookups work offline.
+    """
+    def __init__(self, path="./cache/synthesis.json"):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.isfile(path):
+            with open(path, "rt") as f:
+                self.entries = json.load(f)
+
+    def __repr__(self):
+        return f"SynthesisCache({self.path}, {len(self.entries)} entries)"
+
+    @staticmethod
+    def key(text, voice, language, engine, sample_rate):
+        """Returns the cache key of a part of text read with the given settings."""
+        h = hashlib.sha256()
+        for field in (voice, language, engine, str(sample_rate)):
+            h.update(field.encode('utf-8'))
+            h.update(b"\0")
+        h.update(text.encode('utf-8'))
+        return h.hexdigest()
+
+    def lookup(self, key):
+        """Returns the entry for key, a dict with 's3_key' and/or 'local_path', 'size' and 'md5', or None."""
+        with self.lock:
+            entry = self.entries.get(key)
+            return dict(entry) if entry is not None else None
+
+    def store(self, key, s3_key=None, local_path=None):
+        """Records where the audio for key is kept; locations already recorded are kept unless replaced."""
+        size = md5 = None
+        if local_path is not None:
+            size, md5 = os.path.getsize(local_path), file_md5(local_path)
+        with self.lock:
+            entry = self.entries.setdefault(key, {})
+            if s3_key is not None:
+                entry['s3_key'] = s3_key
+            if local_path is not None:
+                entry.update(local_path=local_path, size=size, md5=md5)
+            self._save()
+
+    @staticmethod
+    def local_audio(entry):
+        """Returns the local file of an entry if it still holds the audio recorded for it, or None."""
+        path = entry.get('local_path')
+        if not path or not entry.get('md5') or not os.path.isfile(path):
+            return None
+        if os.path.getsize(path) != entry.get('size') or file_md5(path) != entry['md5']:
+            return None
+        return path
+
+    def forget(self, key):
+        """Removes an entry whose audio no longer exists."""
+        with self.lock:
+            if self.entries.pop(key, None) is not None:
+                self._save()
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with open(self.path + ".tmp", "wt") as f:
+            json.dump(self.entries, f)
+        os.replace(self.path + ".tmp", self.path)
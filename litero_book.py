@@ -1,35 +1,115 @@
-from litero.litero import Litero
-from litero.story import Story
+from litero.litero import Litero, make_session
+from litero.story import Story, Stories
+from litero.httpcache import HttpCache
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import getopt
 import sys
 import os
 import re
 import pathlib
-import yaml
+import time
+import json
 
 def normalize_title(title):
     path = re.sub(r".txt", "", os.path.basename(title)).lower()
     path = path.replace(' ', '-').replace('!', '').replace(':', '').replace(',','').lower()
     return path
 
-def save_story(story : Story):
-    """ - Load a story as text and turn it into an MP3 using AWS Polly
+def save_story(story : Story, cache : HttpCache = None, session = None):
+    """ - Fetch a story and save it as a single HTML file
 
     story :Story: Reference to a story
+    cache :HttpCache: Optional page cache shared between stories
+    session :requests.Session: Optional connection pool shared between stories
+    Returns the number of bytes written, or None if the HTML file already exists.
     """
-    lit_client = Litero(story)
     output_file = story.get_html_path()
     if os.path.isfile(output_file):
         print(f"skipping {output_file}: already exists")
-        return
+        return None
+    lit_client = Litero(story, cache=cache, session=session)
     os.makedirs(os.path.dirname(output_file), exist_ok=True)
     body = lit_client.get_full_story_html()
     body = body.encode('utf-8', errors='ignore')
-    with open(output_file, "wb") as f:
+    # write to a temporary file first so an interrupted run never leaves a truncated story behind
+    tmp_file = f"{output_file}.{os.getpid()}.tmp"
+    with open(tmp_file, "wb") as f:
         f.write(body)
+    os.replace(tmp_file, output_file)
+    return len(body)
+
+def save_stories(stories, jobs=4, cache : HttpCache = None):
+    """ - Fetch and save a batch of stories, running up to `jobs` stories at a time
+
+    stories :list: Story objects
+    jobs :int: Number of stories fetched concurrently
+    cache :HttpCache: Optional page cache shared between stories
+    Returns a list of (story, exception) for the stories that failed; a failure does not stop the batch.
+    """
+    session = make_session(jobs * 8)
+    failures = []
+    total = len(stories)
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        started = time.time()
+        futures = { pool.submit(save_story, story, cache, session): story for story in stories }
+        for done, future in enumerate(as_completed(futures), 1):
+            story = futures[future]
+            elapsed = time.time() - started
+            try:
+                size = future.result()
+            except Exception as ex:
+                failures.append((story, ex))
+                print(f"[{done}/{total}] {story}: FAILED {ex}")
+                continue
+            if size is None:
+                print(f"[{done}/{total}] {story}: up to date")
+            else:
+                print(f"[{done}/{total}] {story}: saved {size} bytes ({elapsed:.1f}s)")
+    return failures
+
+def page_counts_path(yaml_file):
+    return yaml_file + ".pages.json"
+
+def load_page_counts(yaml_file, stories):
+    """ - Give the stories the chapter page counts recorded by an earlier run, so every page
+    can be scheduled up front.  Counts in the catalog itself take precedence.
+    """
+    path = page_counts_path(yaml_file)
+    if not os.path.isfile(path):
+        return
+    with open(path, 'rt') as f:
+        counts = json.load(f)
+    for story in stories:
+        for chapter in story.get_chapters():
+            if story.get_page_count(chapter.index) is None and chapter.ref in counts:
+                story.set_page_count(chapter.index, counts[chapter.ref])
+
+def save_page_counts(yaml_file, stories):
+    """ - Record the chapter page counts found during the fetch, by chapter reference, in a file
+    next to the catalog, which is left as written.  The file is only rewritten when a count changed.
+    """
+    path = page_counts_path(yaml_file)
+    counts = {}
+    if os.path.isfile(path):
+        with open(path, 'rt') as f:
+            counts = json.load(f)
+    before = dict(counts)
+    for story in stories:
+        for chapter in story.get_chapters():
+            count = story.get_page_count(chapter.index)
+            if count is not None:
+                counts[chapter.ref] = count
+    if counts == before:
+        return
+    with open(path + ".tmp", "wt") as f:
+        json.dump(counts, f, indent=1, sort_keys=True)
+    os.replace(path + ".tmp", path)
 
 def usage(app):
-        print(f"Usage: python {app} <story-def.yaml>")
+        print(f"Usage: python {app} [-j <jobs>] [-o] [-c <cache-dir>] <story-def.yaml>")
+        print("   -j : Number of stories fetched at a time, default 4")
+        print("   -o : Offline, only use pages already in the cache")
+        print("   -c : Page cache directory, default './cache/http'")
         sys.exit(1)
 
 def main(argv):
@@ -38,22 +118,36 @@ def main(argv):
     story = None
     voice = None
     stories = []
+    offline = False
+    cache_dir = "./cache/http"
+    jobs = 4
 
     try:
         args = argv[1:]
+        opts, args = getopt.getopt(args, "j:oc:")
+        opts = dict(opts)
+        if '-j' in opts: jobs = int(opts['-j'])
+        if '-o' in opts: offline = True
+        if '-c' in opts: cache_dir = opts['-c']
         if len(args) < 1: raise Exception("need argument")
     except:
         usage(app)
 
     if len(args)==1 and os.path.isfile(args[0]):
-        with open(args[0], 'rt') as f:
-            stories = yaml.load(f, yaml.loader.SafeLoader)
+        catalog = Stories(args[0])
     else:
         usage(app)
 
-    for story_def in stories['stories']:
-        story = Story(story_def)
-        save_story(story)
+    cache = HttpCache(cache_dir, offline=offline)
+    stories = catalog.get_stories()
+    load_page_counts(args[0], stories)
+    failures = save_stories(stories, jobs, cache)
+    save_page_counts(args[0], stories)
+    if failures:
+        print(f"{len(failures)} of {len(stories)} stories failed:")
+        for story, ex in failures:
+            print(f" - {story}: {ex}")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
@@ -1,46 +1,139 @@
-from turtle import down
 from litero.litero import Litero
-from litero.story import Story
+from litero.story import Story, StoryRefType
+from litero.jobs import JobManifest, Scheduler
+from litero.pollyclient import PollyClient, RateLimiter
+from litero.httpcache import HttpCache
+from litero.synthcache import SynthesisCache
+from litero.publish import Publisher
+from litero import metrics
+from concurrent.futures import ThreadPoolExecutor
 import getopt
 import sys
 import os
 import re
-from distutils.dir_util import copy_tree
 import pathlib
 
+WAIT_TIMEOUT = 120 # seconds to wait on Polly before letting other stories have the worker
+PUBLISH_DIR = "//balrog/www/audio"
+
 def normalize_title(title):
     path = re.sub(r".txt", "", os.path.basename(title)).lower()
     path = path.replace(' ', '-').replace('!', '').replace(':', '').replace(',','').lower()
     return path
 
-def read_story(story : Story, voice, download_only):
-    """ - Load a story as text and turn it into an MP3 using AWS Polly
+class ReaderJob:
+    """ - The stages of reading one story with AWS Polly, run by the batch Scheduler
 
     story :Story: Reference to a story
     voice :str: Amy, Emma, Ivy, Joanna, Kendra, Kimberly, Sally, Joey, Justin, Kevin, Matthew
                 Geraint, Ayanda, Nicole, Olivia, Russell, Aditi, Raveena, Aria
     download_only :bool: Fetches the completed MP3 from AWS without starting a new Polly job
+    publisher :Publisher: Copies the audio to the web share
     """
-    lit_client = Litero(story, voice=voice)
-    ok = os.path.isdir(story.get_audio_path())
-    if not ok:
-        if not download_only:
-            lit_client.read()
-        ok = lit_client.download()
-    if not ok:
-        print("Retry download in a few minutes with the following command:")
-        print(f"python {sys.argv[0]} {story.chapter_ref}")
-    else:
-        audio_path = story.get_audio_path()
-        normalized_title = story.get_normalized_title()
-        cmd = f"cp -a {audio_path}/ //balrog/www/audio/"
-        print(cmd)
-        copy_tree(f'{audio_path}', f'//balrog/www/audio/{normalized_title}')
+    def __init__(self, story : Story, voice, download_only, publisher : Publisher, **litero_args):
+        self.story = story
+        self.download_only = download_only
+        self.publisher = publisher
+        self.lit_client = Litero(story, voice=voice, **litero_args)
+
+    def fetch(self):
+        if self.story.reftype == StoryRefType.LITERO:
+            self.lit_client.fetch_story()
+        return True
+
+    def submit(self):
+        polly = self.lit_client.polly
+        if self.download_only:
+            # recorded only once there is something to download, so a later -r run still reads the story
+            if not polly.tasks and not polly.has_audio():
+                raise Exception("not read yet, run with -r to read it")
+        else:
+            # only submits the parts without a task, or whose task failed
+            self.lit_client.read()
+        return True
+
+    def synthesise(self):
+        # parts are downloaded as soon as their task completes, so this also does most of the downloading
+        polly = self.lit_client.polly
+        if not polly.tasks:
+            # read before task IDs were recorded: check the S3 listing once
+            return not polly.download()
+        try:
+            polly.download_tasks(timeout=WAIT_TIMEOUT)
+        except TimeoutError as ex:
+            print(f"{self.story}: waiting, {ex}")
+            return False
+        return True
+
+    def download(self):
+        return self.lit_client.is_downloaded() or self.synthesise()
+
+    def publish(self):
+        self.publisher.publish(self.story.get_audio_path(), self.story.get_normalized_title())
+        return True
+
+STAGES = [
+    ('fetched', ReaderJob.fetch),
+    ('submitted', ReaderJob.submit),
+    ('synthesised', ReaderJob.synthesise),
+    ('downloaded', ReaderJob.download),
+    ('published', ReaderJob.publish),
+]
+
+def needs_submit(polly : PollyClient):
+    """
+    True unless every part of the story's current text has a Polly task recorded for it, read
+    with the client's voice and the same text, that has not failed.
+    """
+    return bool(polly.stale_parts())
+
+def read_stories(chapter_refs, voice, download_only, manifest : JobManifest, workers=4,
+                 cache : HttpCache = None, synth_cache : SynthesisCache = None, publisher : Publisher = None):
+    """ - Read a batch of stories, running up to `workers` stories at a time
+
+    Each story's progress is recorded in the manifest, so an interrupted batch resumes from the
+    last completed stage of each story.  Stories waiting on Polly are retried without holding a worker.
+    """
+    if not download_only:
+        # stories read before are submitted again if parts are missing, failed, or read from another text or voice
+        read = [ ref for ref in chapter_refs if manifest.stage(ref) in [ name for name, _ in STAGES[1:] ] ]
+        def check(ref):
+            try:
+                return needs_submit(Litero(Story(ref), voice=voice, cache=cache).polly)
+            except Exception as ex:
+                print(f"{ref}: cannot check the recorded reading, submitting again: {ex}")
+                return True
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for ref, stale in zip(read, pool.map(check, read)):
+                if stale:
+                    manifest.rewind(ref, 'fetched')
+    limiter = RateLimiter(5.0)
+    if publisher is None:
+        publisher = Publisher(PUBLISH_DIR)
+    def make_job(chapter_ref):
+        return ReaderJob(Story(chapter_ref), voice, download_only, publisher, cache=cache, synth_cache=synth_cache,
+                         polly_options={ 'limiter': limiter })
+    Scheduler(manifest, STAGES, make_job, workers=workers).run(chapter_refs)
+    refs = set(chapter_refs)
+    failed = [ (ref, error) for ref, stage, error in manifest.jobs() if error and ref in refs ]
+    for ref, error in failed:
+        print(f"FAILED {ref}: {error}")
+    return failed
 
 
 def usage(app):
-        print(f"Usage: python {app} [-r] [-v <voice>] [<story-title>|<list-of-titles-file.txt>|<directory-of-stories>]")
+        print(f"Usage: python {app} [-r] [-o] [-j <jobs>] [-m <manifest>] [-c <cache-dir>] [-s <state-dir>] [-M <metrics-file>] [-P <publish-dir>] [-H] [-v <voice>] [<story-title>|<list-of-titles-file.txt>|<directory-of-stories>]")
         print("   -r : Run the reading job.  Defaults to off, which only downloads a previous reading.")
+        print("   -j : Number of stories processed at a time, default 4")
+        print("   -m : Job manifest recording the progress of each story, default './jobs.sqlite'")
+        print("   -o : Offline, only use story pages already in the cache")
+        print("   -c : Cache directory of the story pages, default './cache/http'")
+        print("   -s : Directory of the synthesis index and the publish record, default './cache'; kept apart from")
+        print("        the page cache, so that it can be cleared without losing them")
+        print(f"   -P : Directory the audio is published to, default '{PUBLISH_DIR}'; only changed files are copied")
+        print("   -H : Compare the content of published files instead of their size and mtime")
+        print("   -M : Record timings and counters of the batch: Prometheus text if the file ends in .prom,")
+        print("        JSON lines otherwise; 'off' disables them.  Default $LITERO_METRICS, or off")
         print("   -v : Select voice, default 'Brian'")
         print("        (en-GB): Amy, Emma")
         print("        (en-US): Ivy, Joanna, Kendra, Kimberly, Sally, Joey, Justin, Kevin, Matthew")
@@ -57,21 +150,37 @@ def main(argv):
     story = None
     voice = None
     stories = []
+    offline = False
+    cache_dir = "./cache/http"
+    state_dir = "./cache"
+    manifest_path = "./jobs.sqlite"
+    workers = 4
+    metrics_path = None
+    publish_dir = PUBLISH_DIR
+    publish_check = 'mtime'
 
     try:
         args = argv[1:]
-        opts, args = getopt.getopt(args, "rv:")
+        opts, args = getopt.getopt(args, "rv:oc:s:j:m:M:P:H")
         opts = dict(opts)
         # print("opts", opts)
         if '-r' in opts: download_only = False
         if '-v' in opts: voice = opts['-v']
+        if '-o' in opts: offline = True
+        if '-c' in opts: cache_dir = opts['-c']
+        if '-s' in opts: state_dir = opts['-s']
+        if '-j' in opts: workers = int(opts['-j'])
+        if '-m' in opts: manifest_path = opts['-m']
+        if '-M' in opts: metrics_path = opts['-M']
+        if '-P' in opts: publish_dir = opts['-P']
+        if '-H' in opts: publish_check = 'hash'
         if len(args) < 1: raise Exception("need argument")
     except:
         usage(app)
 
     if len(args)==1 and os.path.isfile(args[0]):
         with open(args[0], 'rt') as f:
-            stories = f.read().split('\n')
+            stories = [ ll for ll in f.read().split('\n') if ll.strip() ]
     elif len(args)==1 and os.path.isdir(args[0]):
         basedir = pathlib.Path(args[0])
         for path in basedir.glob("**/*.txt"):
@@ -82,9 +191,19 @@ def main(argv):
     else:
         stories = args
 
-    for chapter_ref in stories:
-        story = Story(chapter_ref)
-        read_story(story, voice, download_only)
+    if metrics_path is not None:
+        metrics.configure(metrics_path)
+    cache = HttpCache(cache_dir, offline=offline)
+    synth_cache = SynthesisCache(os.path.join(state_dir, "synthesis.json"))
+    manifest = JobManifest(manifest_path)
+    publisher = Publisher(publish_dir, check=publish_check, record_path=os.path.join(state_dir, "published.json"))
+    failed = read_stories(stories, voice, download_only, manifest, workers, cache, synth_cache, publisher)
+    if metrics.enabled():
+        metrics.flush()
+        print(metrics.summary())
+    if failed:
+        print("Rerun the same command to retry the failed stories from where they stopped.")
+        sys.exit(1)
 
 
 if __name__ == "__main__":
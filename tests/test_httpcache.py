@@ -0,0 +1,120 @@
+import os
+import sys
+import tempfile
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from litero.httpcache import HttpCache
+from litero.story import Story
+
+try:
+    from litero.litero import Litero
+except ImportError:  # the AWS dependencies of the Polly client are not installed
+    Litero = None
+
+ETAG = '"v1"'
+LAST_MODIFIED = "Mon, 01 Jan 2024 00:00:00 GMT"
+
+
+class Handler(BaseHTTPRequestHandler):
+    """Serves /<name> as 'page <name>' with an ETag, answering 304 to a matching If-None-Match."""
+    requests = []
+
+    def do_GET(self):
+        Handler.requests.append((self.path, self.headers.get('If-None-Match'), self.headers.get('If-Modified-Since')))
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.end_headers()
+            return
+        body = f"page {self.path[1:]}".encode()
+        self.send_response(200)
+        self.send_header('ETag', ETAG)
+        self.send_header('Last-Modified', LAST_MODIFIED)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class HttpCacheTest(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        cls.base = f"http://127.0.0.1:{cls.server.server_address[1]}"
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        Handler.requests = []
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def cache(self, **kwargs):
+        cache = HttpCache(self.tmp.name, **kwargs)
+        self.addCleanup(cache.close)
+        return cache
+
+    def client(self, cache):
+        if Litero is None:
+            self.skipTest("litero.litero cannot be imported")
+        return Litero(Story("test-story"), cache=cache)
+
+    def test_fresh_entry_is_served_from_the_cache(self):
+        lit = self.client(self.cache())
+        self.assertEqual(lit.get(self.base + "/a"), "page a")
+        self.assertEqual(lit.get(self.base + "/a"), "page a")
+        self.assertEqual(len(Handler.requests), 1)
+
+    def test_stale_entry_is_revalidated(self):
+        cache = self.cache(max_age=None)
+        lit = self.client(cache)
+        lit.get(self.base + "/a")
+        fetched = cache.lookup(self.base + "/a").fetched
+        self.assertEqual(lit.get(self.base + "/a"), "page a")
+        self.assertEqual(Handler.requests[1], ("/a", ETAG, LAST_MODIFIED))
+        # the 304 confirmed the entry, which counts as fetched again
+        self.assertGreater(cache.lookup(self.base + "/a").fetched, fetched)
+
+    def test_offline(self):
+        self.client(self.cache()).get(self.base + "/a")
+        lit = self.client(self.cache(offline=True, max_age=None))
+        self.assertEqual(lit.get(self.base + "/a"), "page a")
+        with self.assertRaises(Exception):
+            lit.get(self.base + "/b")
+        self.assertEqual(len(Handler.requests), 1)
+
+    def test_store_and_lookup(self):
+        cache = self.cache()
+        self.assertIsNone(cache.lookup("http://x/a"))
+        cache.store("http://x/a", b"body", ETAG, LAST_MODIFIED)
+        entry = cache.lookup("http://x/a")
+        self.assertEqual(entry.body, b"body")
+        self.assertEqual(entry.validators(), { 'If-None-Match': ETAG, 'If-Modified-Since': LAST_MODIFIED })
+        # the index survives a reopen
+        self.assertEqual(self.cache().lookup("http://x/a").body, b"body")
+
+    def test_lru_eviction(self):
+        body = os.urandom(1000)  # does not compress, so each entry takes about 1000 bytes
+        cache = self.cache(max_bytes=2500)
+        cache.store("http://x/a", body)
+        cache.store("http://x/b", body)
+        cache.lookup("http://x/a")  # b is now the least recently used
+        cache.store("http://x/c", body)
+        self.assertIsNotNone(cache.lookup("http://x/a"))
+        self.assertIsNone(cache.lookup("http://x/b"))
+        self.assertIsNotNone(cache.lookup("http://x/c"))
+        self.assertLessEqual(cache.total, 2500)
+
+
+if __name__ == "__main__":
+    unittest.main()
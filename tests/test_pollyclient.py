@@ -0,0 +1,160 @@
+import hashlib
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from litero.story import Story
+from litero.synthcache import SynthesisCache
+
+try:
+    from botocore.exceptions import ClientError
+    from litero.pollyclient import PollyClient, BUCKET
+except ImportError:  # boto3 or the multicloud secrets are not installed
+    PollyClient = None
+
+
+class StubPolly:
+    """Completes every task at once, writing the text of the part as its audio."""
+    def __init__(self, s3):
+        self.s3 = s3
+        self.submitted = []
+        self.tasks = {}
+
+    def start_speech_synthesis_task(self, Text, OutputS3KeyPrefix, **kwargs):
+        task_id = f"t{len(self.submitted) + 1}"
+        key = f"{OutputS3KeyPrefix}.{task_id}.mp3"
+        self.s3.objects[key] = Text.encode()
+        self.submitted.append(Text)
+        self.tasks[task_id] = f"https://s3.us-west-2.amazonaws.com/{BUCKET}/{key}"
+        return { 'SynthesisTask': { 'TaskId': task_id, 'TaskStatus': 'scheduled' } }
+
+    def get_speech_synthesis_task(self, TaskId):
+        return { 'SynthesisTask': { 'TaskStatus': 'completed', 'OutputUri': self.tasks[TaskId] } }
+
+
+class StubS3:
+    def __init__(self):
+        self.objects = {}
+
+    def head_object(self, Bucket, Key):
+        if Key not in self.objects:
+            raise ClientError({ 'Error': { 'Code': '404' } }, 'HeadObject')
+        data = self.objects[Key]
+        return { 'ContentLength': len(data), 'ETag': '"' + hashlib.md5(data).hexdigest() + '"' }
+
+    def download_file(self, bucket, key, fname, Config=None):
+        with open(fname, "wb") as f:
+            f.write(self.objects[key])
+
+    def get_paginator(self, name):
+        return self
+
+    def paginate(self, Bucket, Prefix, Delimiter):
+        # objects are listed by key, and were written in the order they were added
+        contents = [ { 'Key': key, 'Size': len(data), 'ETag': '"' + hashlib.md5(data).hexdigest() + '"', 'LastModified': i }
+                     for i, (key, data) in enumerate(self.objects.items())
+                     if key.startswith(Prefix) and '/' not in key[len(Prefix):] ]
+        yield { 'Contents': sorted(contents, key=lambda itm: itm['Key']) }
+
+
+@unittest.skipIf(PollyClient is None, "litero.pollyclient cannot be imported")
+class PollyClientTest(unittest.TestCase):
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmp = tempfile.TemporaryDirectory()
+        # the story's tasks and audio are kept relative to the working directory
+        os.chdir(self.tmp.name)
+        self.s3 = StubS3()
+        self.polly = StubPolly(self.s3)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmp.cleanup()
+
+    def client(self, parts, story="test-story", **kwargs):
+        return PollyClient(Story(story), parts, polly=self.polly, s3=self.s3, rate=1000, **kwargs)
+
+    def read(self, parts, **kwargs):
+        client = self.client(parts, **kwargs)
+        client.read()
+        client.download_tasks(timeout=1)
+        return client
+
+    def audio(self, part, story="test-story"):
+        with open(self.audio_path(part, story), "rb") as f:
+            return f.read()
+
+    def audio_path(self, part, story="test-story"):
+        return os.path.join(Story(story).get_audio_path(), f"part{part}.mp3")
+
+    def test_unchanged_parts_are_not_resubmitted(self):
+        self.read(["one", "two", "three"])
+        self.read(["one", "two", "three"])
+        self.assertEqual(self.polly.submitted, ["one", "two", "three"])
+
+    def test_changed_part_is_resubmitted(self):
+        self.read(["one", "two", "three"])
+        client = self.read(["one", "TWO", "three"])
+        self.assertEqual(self.polly.submitted[3:], ["TWO"])
+        self.assertEqual(self.audio(2), b"TWO")
+        self.assertEqual(client.stale_parts(), [])
+
+    def test_new_split_resubmits_every_part(self):
+        self.read(["one", "two"])
+        self.read(["one", "two", "three"])
+        self.assertEqual(self.polly.submitted[2:], ["one", "two", "three"])
+
+    def test_download_without_tasks_takes_the_newest_reading(self):
+        self.read(["one", "two"])
+        self.read(["one", "TWO"])
+        os.remove(Story("test-story").get_tasks_path())
+        for part in (1, 2):
+            os.remove(self.audio_path(part))
+        client = self.client(["one", "TWO", "three"])
+        # three objects, but part 3 has not been read yet
+        client.parts = 3
+        self.assertTrue(client.download())
+        client.parts = 2
+        self.assertFalse(client.download())
+        self.assertEqual(self.audio(1), b"one")
+        self.assertEqual(self.audio(2), b"TWO")
+        self.assertEqual(sorted(os.listdir(Story("test-story").get_audio_path())), ["part1.mp3", "part2.mp3"])
+
+    def test_cache_hit_and_miss(self):
+        cache = SynthesisCache("synthesis.json")
+        self.read(["one", "two"], cache=cache)
+        self.read(["two", "three"], story="other-story", cache=cache)
+        # "two" is copied from the first story's audio, only "three" is new
+        self.assertEqual(self.polly.submitted, ["one", "two", "three"])
+        self.assertEqual(self.audio(1, "other-story"), b"two")
+        self.assertEqual(self.audio(2, "other-story"), b"three")
+
+    def test_changed_part_uses_the_cache(self):
+        cache = SynthesisCache("synthesis.json")
+        self.read(["one", "two"], story="other-story", cache=cache)
+        self.read(["one", "three"], cache=cache)
+        self.read(["one", "two"], cache=cache)
+        self.assertEqual(self.polly.submitted, ["one", "two", "three"])
+        self.assertEqual(self.audio(2), b"two")
+
+    def test_stale_local_file(self):
+        cache = SynthesisCache("synthesis.json")
+        self.read(["one"], story="other-story", cache=cache)
+        with open(self.audio_path(1, "other-story"), "wb") as f:
+            f.write(b"overwritten")
+        # the local copy no longer matches its record: the audio comes from S3 instead
+        self.read(["one"], cache=cache)
+        self.assertEqual(self.polly.submitted, ["one"])
+        self.assertEqual(self.audio(1), b"one")
+        # and with the S3 object gone too, the part is read again
+        os.remove(self.audio_path(1))
+        self.s3.objects.clear()
+        self.read(["one"], story="third-story", cache=cache)
+        self.assertEqual(self.polly.submitted, ["one", "one"])
+        self.assertEqual(self.audio(1, "third-story"), b"one")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,67 @@
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from litero.publish import Publisher
+
+
+class PublisherTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.src = os.path.join(self.tmp.name, "audio")
+        self.dest = os.path.join(self.tmp.name, "share")
+        self.record = os.path.join(self.tmp.name, "cache", "published.json")
+        os.makedirs(os.path.join(self.src, "parts"))
+        self.write("01.mp3", b"one")
+        self.write("parts/02.mp3", b"two")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def write(self, name, data, mtime=None):
+        path = os.path.join(self.src, name)
+        with open(path, "wb") as f:
+            f.write(data)
+        if mtime is not None:
+            os.utime(path, (mtime, mtime))
+        return path
+
+    def published(self, name):
+        with open(os.path.join(self.dest, "story", name), "rb") as f:
+            return f.read()
+
+    def test_copy_then_skip(self):
+        publisher = Publisher(self.dest, record_path=self.record)
+        self.assertEqual(publisher.publish(self.src, "story"), (2, 0))
+        self.assertEqual(self.published("01.mp3"), b"one")
+        self.assertEqual(self.published("parts/02.mp3"), b"two")
+        with open(self.record) as f:
+            self.assertEqual(len(json.load(f)), 2)
+        self.assertEqual(publisher.publish(self.src, "story"), (0, 2))
+        # a new publisher reads the record back
+        self.assertEqual(len(Publisher(self.dest, record_path=self.record).published), 2)
+
+    def test_mtime_change_copies(self):
+        publisher = Publisher(self.dest, record_path=self.record)
+        publisher.publish(self.src, "story")
+        self.write("01.mp3", b"new", mtime=os.stat(os.path.join(self.src, "01.mp3")).st_mtime + 10)
+        self.assertEqual(publisher.publish(self.src, "story"), (1, 1))
+        self.assertEqual(self.published("01.mp3"), b"new")
+
+    def test_hash_check_skips_same_content(self):
+        publisher = Publisher(self.dest, check='hash', record_path=self.record)
+        self.assertEqual(publisher.publish(self.src, "story"), (2, 0))
+        self.assertIsNotNone(publisher.published[os.path.join(self.dest, "story", "01.mp3")]['sha256'])
+        # touched but unchanged: skipped by content, where the mtime check would copy it
+        self.write("01.mp3", b"one", mtime=1000000000)
+        self.assertEqual(publisher.publish(self.src, "story"), (0, 2))
+        self.write("01.mp3", b"uno", mtime=1000000000)
+        self.assertEqual(publisher.publish(self.src, "story"), (1, 1))
+        self.assertEqual(self.published("01.mp3"), b"uno")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import os
+import pickle
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+from litero.story import Stories
+
+CATALOG = """
+stories:
+  - title: First
+    chapters: [ "first-story-1", "first-story-2" ]
+  - title: Second
+    chapters: "second-story"
+  - title: First
+    chapters: "first-again"
+"""
+
+
+class StoriesTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.catalog = os.path.join(self.tmp.name, "stories.yaml")
+        with open(self.catalog, "wt") as f:
+            f.write(CATALOG)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def check(self, stories):
+        self.assertEqual(stories.get_titles(), ["First", "Second"])
+        # of two stories with the same title, the last one is found
+        self.assertEqual(stories.get_story("First").chapters, ["first-again"])
+        self.assertEqual(stories.get_story_by_chapter("first-story-2").chapters, ["first-story-1", "first-story-2"])
+        self.assertIsNone(stories.get_story("Third"))
+
+    def test_index_is_reused(self):
+        self.check(Stories(self.catalog))
+        self.assertTrue(os.path.isfile(self.catalog + ".idx"))
+        self.check(Stories(self.catalog))
+
+    def test_unreadable_index_is_rebuilt(self):
+        Stories(self.catalog)
+        for data in (b"\x80\x04garbage", b"{\"stamp\": ", pickle.dumps({ 'stamp': None }), b"[]"):
+            with open(self.catalog + ".idx", "wb") as f:
+                f.write(data)
+            self.check(Stories(self.catalog))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,31 @@
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+try:
+    import tts
+except ImportError:  # torch or kokoro are not installed
+    tts = None
+
+
+@unittest.skipIf(tts is None, "tts cannot be imported")
+class SpeechParserTest(unittest.TestCase):
+    def test_markup_inside_title_is_dropped(self):
+        html = ("<html><head><title>The <i>Book</i><br>Two<p>x</p><h1>y</h1></title></head>"
+                "<body><h1>One</h1><p>Hi.</p></body></html>")
+        self.assertEqual(tts.html_to_tts_chunks(html),
+                         ["[cinematic] One", "[break=medium]", "Hi.", "[break=tiny]", "[break=small]"])
+
+    def test_markup_inside_noscript_is_dropped(self):
+        self.assertEqual(tts.html_to_tts_chunks("<noscript><div>No.<br/></div></noscript><p>Hi.</p>"),
+                         ["Hi.", "[break=tiny]", "[break=small]"])
+
+    def test_streamed_in_small_blocks(self):
+        html = "<title>A<br>B</title><p>One. <em>Two</em></p><div>Three</div>"
+        self.assertEqual(list(tts.iter_tts_chunks(html, block_size=3)), tts.html_to_tts_chunks(html))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,190 +1,582 @@
 import argparse
+import hashlib
+import importlib.metadata
+import json
+import multiprocessing
 import os
+import platform
 import re
+import shutil
+import sqlite3
+import struct
+import subprocess
 import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from html.parser import HTMLParser
 from pathlib import Path
-from typing import List
-
-try:
-    from bs4 import BeautifulSoup  # type: ignore
-except ImportError:
-    BeautifulSoup = None  # type: ignore
+from typing import Iterable, Iterator, List, NamedTuple, TextIO, Tuple
 
+import numpy as np
 import torch
 from kokoro import KPipeline
 
-try:
-    from pydub import AudioSegment  # type: ignore
-except ImportError:
-    AudioSegment = None  # type: ignore
+from litero import metrics
 
 
-def html_to_tts_chunks(html_string: str) -> List[str]:
-    """Convert HTML string to TTS (Text-to-Speech) chunks.
-    This method processes an HTML document and converts it into
-    text, one sentence per chunk.  After each paragraph a 
-    marker string "[break=medium]" is added to indicate a medium 
-    break duration.
+HEADINGS = { "h1", "h2", "h3", "h4", "h5", "h6" }
+EMPHASIS = { "em", "i", "strong", "b" }
+NON_SPEECH = { "script", "style", "noscript", "meta", "link", "title" }
+VOID_TAGS = { "area", "base", "br", "col", "embed", "hr", "img", "input", "link", "meta", "source", "track", "wbr" }
+MARKERS = re.compile(r"(\[break=[^]]+\]|\[cinematic\]|\[excited\])")
 
-    Maps common HTML elements to their StyleTTS2 equivalents:
-    - <em>, <i> -> '[excited]'
-    - <strong>, <b> -> '[excited]'
-    - <p> -> ends the chunk and adds '[break=medium]' between paragraphs
-    - <br> -> ends the chunk and adds '[break=small]' between lines
-    - <h1>-<h6> -> Adds '[cinematic]' before, and '[break=medium]' after headings
-    - <div> -> adds '[break=small]' between divs
-    - <span> -> preserved as text content
-    - Removes script, style, and other non-speech elements
-    
-    Args:
-        html_string: The HTML content as a string
-        
-    Returns:
-        TTS formatted List[str]
-    """
-    tts_chunks: List[str] = []
-    if not BeautifulSoup:
-        raise RuntimeError("BeautifulSoup is required for HTML parsing.")
-    else:
-        # Use BeautifulSoup for better parsing
-        soup = BeautifulSoup(html_string, "html.parser")
-        
-        # Remove script, style, and other non-speech elements
-        for tag in soup(["script", "style", "noscript", "meta", "link", "title"]):
-            tag.decompose()
-        
-        # Process elements in document order
-        for element in soup.descendants:
-            if element.name in ["h1", "h2", "h3", "h4", "h5", "h6"]:
-                # Add cinematic marker before heading
-                cinematic_tag = soup.new_string("[cinematic]")
-                element.insert_before(cinematic_tag)
-                # Add break after heading
-                break_tag = soup.new_string("[break=medium]")
-                element.insert_after(break_tag)
-                
-            elif element.name in ["em", "i", "strong", "b"]:
-                # Add excited marker before emphasis
-                #excited_tag = soup.new_string("[excited]")
-                element.replace_with(f"[{element.get_text()}](+8)")
-                
-            elif element.name == "br":
-                element.replace_with("[break=small]")
-                
-            elif element.name == "p":
-                # Add break after paragraph
-                break_tag = soup.new_string("[break=small]")
-                element.insert_after(break_tag)
-                
-            elif element.name == "div":
-                # Add small break after div
-                break_tag = soup.new_string("[break=small]")
-                element.insert_after(break_tag)
-        
-        # Get text content
-        text = soup.get_text()
-        
-        # Clean up and split into chunks
-        # Split by break markers and sentence boundaries
-        parts = re.split(r"(\[break=[^]]+\]|\[cinematic\]|\[excited\])", text)
-        current_chunk = ""
-        
+
+class _SpeechParser(HTMLParser):
+    """Turns HTML parse events into text with the TTS markers inserted, as a list of pieces."""
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.pieces: List[str] = []
+        self.stack: List[str] = []     # open elements, innermost last
+        self.skip = 0                  # depth inside non-speech elements
+        self.emphasis: int | None = None  # stack depth of the emphasis element being captured
+        self.captured: List[str] = []
+
+    def marker(self, text: str):
+        # the soup drops non-speech elements with everything inside them
+        if self.emphasis is None and not self.skip:
+            self.pieces.append(text)
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "br":
+            self.marker("[break=small]")
+            return
+        if tag in VOID_TAGS:
+            return
+        self.stack.append(tag)
+        if tag in NON_SPEECH:
+            self.skip += 1
+        elif tag in HEADINGS:
+            self.marker("[cinematic]")
+        elif tag in EMPHASIS and self.emphasis is None and not self.skip:
+            self.emphasis = len(self.stack)
+            self.captured = []
+
+    def handle_startendtag(self, tag, attrs):
+        if tag == "br":
+            self.marker("[break=small]")
+        elif tag not in VOID_TAGS:
+            self.handle_starttag(tag, attrs)
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # like html.parser based soup, an end tag closes every element opened after its match
+        if tag not in self.stack:
+            return
+        while self.stack:
+            open_tag = self.stack.pop()
+            self.close(open_tag)
+            if open_tag == tag:
+                break
+
+    def close(self, tag):
+        if tag in NON_SPEECH:
+            self.skip -= 1
+        elif self.emphasis is not None and len(self.stack) < self.emphasis:
+            self.emphasis = None
+            self.pieces.append(f"[{''.join(self.captured)}](+8)")
+        elif tag in HEADINGS:
+            self.marker("[break=medium]")
+        elif tag in ("p", "div"):
+            self.marker("[break=small]")
+
+    def handle_data(self, data):
+        if self.skip:
+            return
+        if self.emphasis is not None:
+            self.captured.append(data)
+        else:
+            self.pieces.append(data)
+
+    def finish(self):
+        """Ends the document, closing the elements still open like the soup would."""
+        super().close()
+        while self.stack:
+            self.close(self.stack.pop())
+
+
+class _Chunker:
+    """Splits marked-up text into sentence chunks and break markers, one text segment at a time."""
+    def __init__(self):
+        self.current_chunk = ""
+
+    def feed(self, text: str) -> Iterator[str]:
+        parts = MARKERS.split(text)
         for part in parts:
             part = part.strip()
             if not part:
                 continue
-                
+
             if part.startswith("[") and part.endswith("]"):
                 # Handle special markers
                 if part.startswith("[break="):
                     # Add current chunk if it has content
-                    if current_chunk.strip():
-                        tts_chunks.append(current_chunk.strip())
-                        current_chunk = ""
+                    if self.current_chunk.strip():
+                        yield self.current_chunk.strip()
+                        self.current_chunk = ""
                     # Add the break marker as a separate chunk
-                    tts_chunks.append(part)
+                    yield part
                 else:
                     # Style markers like [cinematic] or [excited] get added to current chunk
-                    if current_chunk:
-                        current_chunk += part
+                    if self.current_chunk:
+                        self.current_chunk += part
                     else:
-                        current_chunk = part
+                        self.current_chunk = part
             else:
                 # Regular text - split into sentences
                 sentences = re.split(r"(?<=[.!?])\s+", part)
                 for sentence in sentences:
                     sentence = sentence.strip()
                     if sentence:
-                        if current_chunk:
-                            current_chunk += " " + sentence
+                        if self.current_chunk:
+                            self.current_chunk += " " + sentence
                         else:
-                            current_chunk = sentence
-                        
+                            self.current_chunk = sentence
+
                         # Check if sentence ends with punctuation, create chunk
                         if re.search(r"[.!?]$", sentence):
-                            tts_chunks.append(current_chunk.strip())
-                            tts_chunks.append("[break=tiny]")
-                            current_chunk = ""
-        
+                            yield self.current_chunk.strip()
+                            yield "[break=tiny]"
+                            self.current_chunk = ""
+
+    def flush(self) -> Iterator[str]:
         # Add any remaining text
-        if current_chunk.strip():
-            tts_chunks.append(current_chunk.strip())
-    
-    # Clean up whitespace in chunks and remove empty chunks
-    tts_chunks = [re.sub(r"\s+", " ", chunk).strip() for chunk in tts_chunks if chunk.strip()]
+        if self.current_chunk.strip():
+            yield self.current_chunk.strip()
+        self.current_chunk = ""
+
+
+def iter_tts_chunks(html: str | TextIO, block_size: int = 65536) -> Iterator[str]:
+    """Convert an HTML document to TTS (Text-to-Speech) chunks as a stream.
+
+    The document is parsed once, in blocks of block_size characters when a file is given, and
+    chunks are yielded as soon as the text before the next marker is complete, so synthesis
+    can start on the first sentence while the rest of the document is still being read.
+    See html_to_tts_chunks() for the markers produced.
+
+    Args:
+        html: The HTML content as a string, or a text file to read it from
+        block_size: Number of characters parsed at a time
+
+    Yields:
+        TTS formatted chunks
+    """
+    parser = _SpeechParser()
+    chunker = _Chunker()
+    pending: List[str] = []
+
+    def clean(chunks: Iterator[str]) -> Iterator[str]:
+        # Clean up whitespace in chunks and remove empty chunks
+        for chunk in chunks:
+            chunk = re.sub(r"\s+", " ", chunk).strip()
+            if chunk:
+                yield chunk
+
+    def drain() -> Iterator[str]:
+        # Text can only be chunked once the marker that ends it has been seen
+        pieces, parser.pieces = parser.pieces, []
+        for piece in pieces:
+            pending.append(piece)
+            if MARKERS.fullmatch(piece):
+                yield from clean(chunker.feed("".join(pending)))
+                pending.clear()
+
+    if isinstance(html, str):
+        blocks: Iterable[str] = (html[i:i+block_size] for i in range(0, len(html), block_size))
+    else:
+        blocks = iter(lambda: html.read(block_size), "")
+    for block in blocks:
+        parser.feed(block)
+        yield from drain()
+    parser.finish()
+    yield from drain()
+    yield from clean(chunker.feed("".join(pending)))
+    yield from clean(chunker.flush())
+
+
+def html_to_tts_chunks(html_string: str) -> List[str]:
+    """Convert HTML string to TTS (Text-to-Speech) chunks.
+    This method processes an HTML document and converts it into
+    text, one sentence per chunk.  After each paragraph a 
+    marker string "[break=small]" is added to indicate a small
+    break duration.
+
+    Maps common HTML elements to their StyleTTS2 equivalents:
+    - <em>, <i>, <strong>, <b> -> '[text](+8)'
+    - <p> -> ends the chunk and adds '[break=small]' between paragraphs
+    - <br> -> ends the chunk and adds '[break=small]' between lines
+    - <h1>-<h6> -> Adds '[cinematic]' before, and '[break=medium]' after headings
+    - <div> -> adds '[break=small]' between divs
+    - <span> -> preserved as text content
+    - Removes script, style, and other non-speech elements
     
-    return tts_chunks
+    Args:
+        html_string: The HTML content as a string
+        
+    Returns:
+        TTS formatted List[str]
+    """
+    return list(iter_tts_chunks(html_string))
+
+def pack_chunks(chunks: Iterable[str], max_chars: int = 400) -> Iterator[str]:
+    """Merge consecutive sentence chunks into batches of up to max_chars characters.
+
+    Each chunk is one call to the Kokoro pipeline, which has a fixed cost per call, so reading
+    a book one sentence at a time is much slower than reading a few sentences at once.  The
+    [break=tiny] between sentences of a batch is dropped, leaving the pause the voice makes at
+    the end of a sentence.  Small, medium and large breaks, style markers and headings always
+    end a batch.  A sentence longer than max_chars is passed through on its own.
+
+    Args:
+        chunks: TTS chunks as produced by iter_tts_chunks()
+        max_chars: Maximum characters per batch; 0 passes the chunks through unchanged
+
+    Yields:
+        TTS formatted chunks
+    """
+    batch: List[str] = []
+    size = 0
+    pause = False  # the last sentence in the batch was followed by a [break=tiny]
+    for chunk in chunks:
+        if max_chars <= 0:
+            yield chunk
+            continue
+        if chunk == "[break=tiny]" and batch:
+            pause = True
+            continue
+        sentence = not chunk.startswith(("[break=", "[cinematic]", "[excited]"))
+        if sentence and pause and size + 1 + len(chunk) <= max_chars:
+            batch.append(chunk)
+            size += 1 + len(chunk)
+            pause = False
+            continue
+        if batch:
+            yield " ".join(batch)
+            if pause:
+                yield "[break=tiny]"
+            batch, size, pause = [], 0, False
+        if sentence:
+            batch.append(chunk)
+            size = len(chunk)
+        else:
+            yield chunk
+    if batch:
+        yield " ".join(batch)
+        if pause:
+            yield "[break=tiny]"
+
+SAMPLE_RATE = 24000  # Kokoro sample rate
+
+try:
+    MODEL_VERSION = "kokoro " + importlib.metadata.version("kokoro")
+except importlib.metadata.PackageNotFoundError:
+    MODEL_VERSION = "kokoro"
+
+MODEL_DIR = "./cache/models"  # optimized models saved by load_pipeline()
+
+def model_version(quantize: bool = False) -> str:
+    """Returns the name of the model variant, which changes the audio it produces."""
+    return MODEL_VERSION + (" int8" if quantize else "")
+
+def load_pipeline(device: str | None, quantize: bool = False, model_dir: str = MODEL_DIR) -> KPipeline:
+    """Load a Kokoro pipeline, optionally with the model optimized for CPU inference.
+
+    With quantize, the model's Linear layers are converted to dynamic int8 quantization and
+    forward() runs in torch.inference_mode().  Quantizing means loading the float32 model
+    first, so the quantized model is saved in model_dir, by kokoro and torch version, and
+    loaded directly from there afterwards.  Check its quality with quality_check().
+    """
+    if not quantize:
+        return KPipeline(lang_code='a', device=device)
+    if device not in (None, 'cpu'):
+        raise RuntimeError("Quantized inference is only available on the CPU.")
+    version = MODEL_VERSION.split()[-1]
+    path = os.path.join(model_dir, f"kokoro-{version}-int8-torch{torch.__version__}.pt")
+    model = None
+    if os.path.isfile(path):
+        try:
+            model = torch.load(path, weights_only=False)
+        except Exception as ex:
+            print(f"[TTS] cannot load {path}, quantizing again: {ex}", file=sys.stderr)
+    if model is None:
+        model = KPipeline(lang_code='a', device='cpu').model.eval()
+        model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+        os.makedirs(model_dir, exist_ok=True)
+        torch.save(model, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        print(f"[TTS] saved quantized model {path}")
+    model.forward = torch.inference_mode()(model.forward)
+    return KPipeline(lang_code='a', device='cpu', model=model)
+
+class AudioCache:
+    """
+    Persistent on-disk cache of synthesized speech, one entry per TTS chunk.
+
+    Entries are keyed by a hash of the normalized chunk text, the voice, the speed and the model
+    version, so re-rendering an edited book only runs Kokoro on the chunks that changed, and a
+    chunk repeated within a book (e.g. a "Page N" heading) is synthesized once.  Each entry is a
+    file holding a small header (magic, sample count, scale) followed by the audio as 16 bit
+    PCM scaled to the chunk's own peak, half the size of float32.  A SQLite index holds the
+    sizes and last access times used for LRU eviction.  Worker processes may share a cache: the
+    total size is read from the index in the transaction that evicts, never kept per process.
+    """
+    MAGIC = b"KPC1"
+    HEADER = struct.Struct("<4sIf")  # magic, samples, scale
+
+    def __init__(self, cache_dir: str = "./cache/tts", max_bytes: int = 2*1024*1024*1024, model: str = MODEL_VERSION):
+        """
+        Args:
+            cache_dir: Directory holding the index and the audio files
+            max_bytes: Upper bound on the total size; least recently used entries are evicted beyond it
+            model: Model variant the audio is synthesized with, see model_version()
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.model = model
+        os.makedirs(cache_dir, exist_ok=True)
+        self.db = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"), timeout=60)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            accessed REAL NOT NULL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+        self.db.commit()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return f"AudioCache({self.cache_dir}, {self.total} bytes)"
+
+    @property
+    def total(self) -> int:
+        """Total size of the entries, in bytes, of every process using the cache."""
+        return self.db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    @staticmethod
+    def key(text: str, voice: str, speed: float, model: str = MODEL_VERSION) -> str:
+        """Returns the cache key of a chunk of text read with the given settings."""
+        h = hashlib.sha256()
+        for field in (model, voice, repr(float(speed))):
+            h.update(field.encode('utf-8'))
+            h.update(b"\0")
+        h.update(re.sub(r"\s+", " ", text).strip().encode('utf-8'))
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], key + ".pcm")
+
+    def lookup(self, key: str) -> torch.Tensor | None:
+        """Returns the audio cached for key as a float32 tensor, or None if it is not cached."""
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            magic, samples, scale = self.HEADER.unpack_from(data)
+            pcm = np.frombuffer(data, dtype=np.int16, offset=self.HEADER.size)
+            if magic != self.MAGIC or len(pcm) != samples:
+                raise ValueError(f"corrupt cache entry {key}")
+        except (OSError, ValueError, struct.error):
+            self._remove(key)
+            self.misses += 1
+            return None
+        self.db.execute("UPDATE entries SET accessed = ? WHERE key = ?", (time.time(), key))
+        self.db.commit()
+        self.hits += 1
+        return torch.from_numpy(pcm.astype(np.float32) * scale)
+
+    def store(self, key: str, audio: torch.Tensor):
+        """Stores the audio for key, evicting old entries if the cache is full."""
+        samples = audio.numpy().astype(np.float32, copy=False)
+        peak = float(np.abs(samples).max()) if len(samples) else 0.0
+        scale = peak / 32767 if peak > 0 else 1.0
+        pcm = np.round(samples / scale).astype(np.int16)
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(self.HEADER.pack(self.MAGIC, len(pcm), scale))
+            f.write(pcm.tobytes())
+        os.replace(tmp, path)
+        size = self.HEADER.size + pcm.nbytes
+        # the insert takes the index's write lock, so no other process changes the total
+        # between reading it and evicting
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (key, size, time.time()))
+            evicted = self._evict()
+        for old in evicted:
+            self._remove_file(old)
+
+    def _remove(self, key: str):
+        with self.db:
+            self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._remove_file(key)
+
+    def _remove_file(self, key: str):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
 
-silence_audio = torch.zeros(24000, dtype=torch.float32)  # 1 second of silence at 24kHz
+    def _evict(self) -> List[str]:
+        """Deletes the least recently used entries beyond max_bytes from the index, in the
+        caller's transaction; returns their keys, whose files are removed once it commits."""
+        total = self.total
+        if total <= self.max_bytes:
+            return []
+        evicted = []
+        for key, size in self.db.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            if total <= self.max_bytes:
+                break
+            evicted.append(key)
+            total -= size
+        self.db.executemany("DELETE FROM entries WHERE key = ?", [ (key,) for key in evicted ])
+        return evicted
+
+    def close(self):
+        self.db.close()
+
+
+silence_audio = torch.zeros(SAMPLE_RATE, dtype=torch.float32)  # 1 second of silence at 24kHz
+
+class _LazyPipeline:
+    """A Kokoro pipeline that is only loaded when the first chunk has to be synthesized."""
+    def __init__(self, device: str | None, quantize: bool = False):
+        self.device = device
+        self.quantize = quantize
+        self.pipeline: KPipeline | None = None
+
+    def __call__(self, *args, **kwargs):
+        if self.pipeline is None:
+            self.pipeline = load_pipeline(self.device, self.quantize)
+        return self.pipeline(*args, **kwargs)
+
+def collapse_break(chunk: str, break_time: float) -> Tuple[float, float]:
+    """Returns the seconds of silence for a break marker and the new break state.
+
+    Consecutive breaks collapse to just the longest, so the silence of a break depends on the
+    breaks before it since the last sentence; break_time carries that state from chunk to chunk.
+    """
+    match = re.match(r"\[break=(tiny|small|medium|large)\]", chunk)
+    if not match:
+        return 0, break_time
+    duration_map = {'tiny': 0.1, 'small': 0.3, 'medium': 0.6, 'large': 1.0}
+    duration = duration_map.get(match.group(1), 0.5)
+    if break_time >= 0:
+        # collapse multiple breaks to just the longest
+        duration -= break_time
+        break_time = duration
+    return duration, break_time
+
+def next_break_time(chunk: str, break_time: float) -> float:
+    """Returns the break state after chunk, without synthesizing it."""
+    if chunk.startswith("[break="):
+        return collapse_break(chunk, break_time)[1]
+    if chunk.startswith(("[cinematic]", "[excited]")):
+        return break_time
+    return 0
+
+def iter_audio(chunks: Iterable[str], voice: str, speed: float, device: str | None, pipeline: KPipeline | None = None, cache: AudioCache | None = None,
+               break_time: float = 0) -> Iterator[torch.Tensor]:
+    """Synthesize TTS chunks, yielding each block of audio as soon as it is produced.
+
+    Args:
+        chunks: TTS chunks as produced by iter_tts_chunks()
+        voice: Kokoro voice name
+        speed: Speech speed multiplier
+        device: Torch device, used if no pipeline is given
+        pipeline: Kokoro pipeline to reuse; one is only created if a chunk is not cached
+        cache: Audio cache to read chunks from and store new chunks in
+        break_time: Break state left by the chunks before these, see collapse_break()
+
+    Yields:
+        1-D CPU float32 tensors of audio at SAMPLE_RATE, not normalized
+    """
+    if pipeline is None:
+        pipeline = _LazyPipeline(device)
+    start = time.perf_counter()
+    samples = 0
+
+    def speak(text: str, voice: str, speed: float) -> Iterator[torch.Tensor]:
+        key = cache.key(text, voice, speed, cache.model) if cache else None
+        if key:
+            audio = cache.lookup(key)
+            if audio is not None:
+                metrics.count('tts_chunks_total', source='cache')
+                yield audio
+                return
+        blocks = []
+        # synthesis time of the chunk, leaving out the time the caller holds each block
+        elapsed = 0.0
+        t = time.perf_counter()
+        for _, _, audio in pipeline(text, voice=voice, speed=speed):
+            elapsed += time.perf_counter() - t
+            if audio is not None:
+                # Ensure 1-D CPU float32 tensor
+                blocks.append(audio.detach().cpu().float())
+                yield blocks[-1]
+            t = time.perf_counter()
+        elapsed += time.perf_counter() - t
+        metrics.count('tts_chunks_total', source='model')
+        metrics.observe('tts_chunk_seconds', elapsed)
+        if key and blocks:
+            cache.store(key, torch.cat(blocks))
 
-def synthesize(chunks: List[str], voice: str, speed: float, device: str | None) -> torch.Tensor:
-    pipeline = KPipeline(lang_code='a', device=device)
-    audio_segments: List[torch.Tensor] = []
-    break_time = 0
     for idx, chunk in enumerate(chunks, 1):
-        print(f"[TTS] Synthesizing chunk {idx}/{len(chunks)} (len={len(chunk)})")
+        print(f"[TTS] Synthesizing chunk {idx} (len={len(chunk)})")
         #if idx > 100: break # testing
 
         # Handle special break markers
         if chunk.startswith("[break="):
             # Handle break markers as silent audio
-            match = re.match(r"\[break=(tiny|small|medium|large)\]", chunk)
-            if match:
-                duration_map = {'tiny': 0.1, 'small': 0.3, 'medium': 0.6, 'large': 1.0}
-                duration = duration_map.get(match.group(1), 0.5)
-                if break_time >= 0:
-                    # collapse multiple breaks to just the longest
-                    duration -= break_time
-                    break_time = duration
-                    if duration <= 0:
-                        continue
-                sr = 24000  # Kokoro sample rate
-                num_silent_samples = int(sr * duration)
-                audio_segments.append(silence_audio[:num_silent_samples])
+            duration, break_time = collapse_break(chunk, break_time)
+            if duration > 0:
+                num_silent_samples = int(SAMPLE_RATE * duration)
+                samples += num_silent_samples
+                yield silence_audio[:num_silent_samples]
             continue
 
         if chunk.startswith("[cinematic]"):
             chunk = chunk.replace("[cinematic]", "").strip()
             # Apply cinematic effects (e.g., reverb)
-            for _, _, audio in pipeline(chunk, voice="am_michael", speed=speed): #, effects=["reverb"]):
-                if audio is not None:
-                    audio_segments.append(audio.detach().cpu().float())
+            for audio in speak(chunk, voice="am_michael", speed=speed): #, effects=["reverb"]):
+                samples += audio.numel()
+                yield audio
             continue
 
         if chunk.startswith("[excited]"):
             chunk = chunk.replace("[excited]", "").strip()
             # Apply excited style (e.g., higher pitch)
-            for _, _, audio in pipeline(chunk, voice=voice, speed=speed*1.2): #, effects=["pitch=1.2"]):
-                if audio is not None:
-                    audio_segments.append(audio.detach().cpu().float())
+            for audio in speak(chunk, voice=voice, speed=speed*1.2): #, effects=["pitch=1.2"]):
+                samples += audio.numel()
+                yield audio
             continue
 
         break_time = 0
         # Synthesize speech for the chunk
-        for _, _, audio in pipeline(chunk, voice=voice, speed=speed):
-            if audio is not None:
-                # Ensure 1-D CPU float32 tensor
-                audio_segments.append(audio.detach().cpu().float())
+        for audio in speak(chunk, voice=voice, speed=speed):
+            samples += audio.numel()
+            yield audio
+    if samples:
+        elapsed = time.perf_counter() - start
+        seconds = samples / SAMPLE_RATE
+        metrics.count('tts_audio_seconds_total', seconds)
+        print(f"[TTS] {idx} chunks, {seconds:.1f}s of audio in {elapsed:.1f}s (RTF {elapsed/seconds:.3f})")
+    if cache:
+        print(f"[TTS] audio cache: {cache.hits} hits, {cache.misses} misses")
+
+def synthesize(chunks: Iterable[str], voice: str, speed: float, device: str | None, pipeline: KPipeline | None = None) -> torch.Tensor:
+    """Synthesize TTS chunks into a single normalized waveform held in memory.
+    Use iter_audio() and AudioSpool for books, whose audio may not fit in memory."""
+    audio_segments = list(iter_audio(chunks, voice, speed, device, pipeline))
     if not audio_segments:
         raise RuntimeError("No audio generated.")
     audio_full = torch.cat(audio_segments)
@@ -194,65 +586,558 @@ def synthesize(chunks: List[str], voice: str, speed: float, device: str | None)
         audio_full = audio_full / peak * 0.95
     return audio_full
 
+
+class AudioSpool:
+    """Audio spilled to a temporary float32 file as it is produced, with its peak tracked.
+
+    Normalising a book needs its peak before the first sample can be written, so the audio is
+    written out once and read back in blocks, scaled, on the way to the encoder.  Memory use
+    stays at one block whatever the length of the book.  The file should be put on a disk
+    rather than a tmpfs, which is why dir can be given.  A spool given a path writes a named
+    file that outlives it, so a section rendered by another process can be read back.
+    """
+    def __init__(self, dir: str | None = None, block_samples: int = SAMPLE_RATE * 10, path: str | None = None):
+        if path:
+            self.file = open(path, "w+b")
+        else:
+            self.file = tempfile.TemporaryFile(dir=dir, suffix=".f32")
+        self.block_samples = block_samples
+        self.samples = 0
+        self.peak = 0.0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.file.close()
+
+    def write(self, audio: torch.Tensor):
+        if audio.numel() == 0:
+            return
+        self.peak = max(self.peak, audio.abs().max().item())
+        self.samples += audio.numel()
+        self.file.write(audio.numpy().astype(np.float32, copy=False).tobytes())
+
+    def pcm16(self, level: float = 0.95) -> Iterator[bytes]:
+        """Yields the audio as blocks of 16 bit PCM, normalized so its peak is at level."""
+        scale = level / self.peak if self.peak > 0 else 1.0
+        self.file.seek(0)
+        yield from pcm16_blocks(self.file, scale, self.block_samples)
+
+
+def pcm16_blocks(f, scale: float, block_samples: int = SAMPLE_RATE * 10) -> Iterator[bytes]:
+    """Reads float32 audio from a file and yields it scaled, as blocks of 16 bit PCM."""
+    while True:
+        data = f.read(block_samples * 4)
+        if not data:
+            break
+        block = np.frombuffer(data, dtype=np.float32) * scale
+        yield (np.clip(block, -1, 1) * 32767).astype(np.int16).tobytes()
+
+
+class Section(NamedTuple):
+    """A run of chunks from one heading to the next, rendered on its own as an m4b chapter."""
+    title: str | None      # heading text; None before the first heading
+    chunks: List[str]
+    break_time: float      # break state at the start of the section, see collapse_break()
+
+    @property
+    def heading_only(self) -> bool:
+        """True if the section has nothing to say but its heading, e.g. a chapter heading followed by a page heading."""
+        return self.title is not None and sum(1 for c in self.chunks if not c.startswith("[break=")) == 1
+
+def split_sections(chunks: Iterable[str]) -> Iterator[Section]:
+    """Split a book's chunks into sections, starting a new section at every heading.
+
+    Each section is yielded as soon as the next heading is reached, so the first can be
+    rendered while the rest of the book is still being parsed.  The break state at the start
+    of each section is worked out here, by a pass over the chunks that does not synthesize
+    anything, so that sections rendered separately produce exactly the same silences as the
+    whole book rendered in one go.  A run of chunks with nothing to say (e.g. only breaks
+    before the first heading) is carried over to the start of the next section.
+    """
+    current: List[str] = []
+    title = None
+    break_time = start_break = 0
+
+    for chunk in chunks:
+        if chunk.startswith("[cinematic]"):
+            if any(not c.startswith("[break=") for c in current):
+                yield Section(title, current, start_break)
+                current = []
+                start_break = break_time
+            title = chunk.replace("[cinematic]", "").strip()
+        current.append(chunk)
+        break_time = next_break_time(chunk, break_time)
+    if any(not c.startswith("[break=") for c in current):
+        yield Section(title, current, start_break)
+
+def split_shards(sections: List[Section], jobs: int, min_chars: int = 2000) -> List[Tuple[int, Section]]:
+    """Split sections into contiguous shards small enough to keep jobs workers busy.
+
+    A book with a few long chapters, or none, would otherwise leave most workers idle.  Shards
+    are cut at about a quarter of each worker's share of the book, and never below min_chars
+    characters, so that the cost of a pipeline call stays small next to the speech in a shard.
+    Shards start with a spoken chunk and carry the break state left by the chunks before them,
+    so the silences are the same however the book is cut.
+
+    Returns:
+        (index of the section, shard) pairs in book order
+    """
+    if jobs <= 1:
+        return list(enumerate(sections))
+    total = sum(len(c) for section in sections for c in section.chunks)
+    target = max(min_chars, total // (jobs * 4))
+    shards = []
+    for idx, section in enumerate(sections):
+        chunks: List[str] = []
+        size = 0
+        break_time = start_break = section.break_time
+        for chunk in section.chunks:
+            if size >= target and not chunk.startswith("[break="):
+                shards.append((idx, Section(section.title, chunks, start_break)))
+                chunks, size, start_break = [], 0, break_time
+            chunks.append(chunk)
+            size += len(chunk)
+            break_time = next_break_time(chunk, break_time)
+        shards.append((idx, Section(section.title, chunks, start_break)))
+    return shards
+
+def autotune(device: str | None, sample: List[str], voice: str, speed: float, path: str, quantize: bool = False) -> Tuple[int, int]:
+    """Choose the number of worker processes and torch threads per worker for this host.
+
+    Kokoro gains less and less from more intra-op threads, so on a CPU with many cores several
+    single-threaded processes usually beat one process using every core, until memory
+    bandwidth runs out.  The sample sentences are timed in this process at each thread count
+    from 1 up to the number of cores, and the split with the highest total throughput (processes
+    x speech per second of one process) is chosen.  The choice is saved in path by host, device
+    and model version, so tuning runs once per machine.  A GPU gets one process.
+
+    Returns:
+        (processes, threads)
+    """
+    cores = os.cpu_count() or 1
+    host = f"{platform.node()} {platform.machine()} {cores} cores {device or 'cpu'} {model_version(quantize)}"
+    tuned = {}
+    if os.path.isfile(path):
+        with open(path, "rt") as f:
+            tuned = json.load(f)
+    if host in tuned:
+        return tuple(tuned[host])
+    if device not in (None, 'cpu'):
+        return 1, cores
+
+    pipeline = load_pipeline(device, quantize)
+    saved_threads = torch.get_num_threads()
+
+    def rate(threads: int) -> float:
+        torch.set_num_threads(threads)
+        samples = 0
+        start = time.perf_counter()
+        for text in sample:
+            for _, _, audio in pipeline(text, voice=voice, speed=speed):
+                if audio is not None:
+                    samples += audio.numel()
+        return samples / SAMPLE_RATE / (time.perf_counter() - start)
+
+    candidates = sorted({ 2**i for i in range(cores.bit_length()) if 2**i <= cores } | { cores })
+    rate(candidates[0])  # warm up
+    best = (0.0, 1, cores)
+    for threads in candidates:
+        processes = cores // threads
+        speech = rate(threads)
+        print(f"[autotune] {threads:3d} threads: {speech:6.2f}s of speech/s per process, x{processes} processes = {speech*processes:7.2f}")
+        best = max(best, (speech * processes, processes, threads))
+    torch.set_num_threads(saved_threads)
+    _, processes, threads = best
+    tuned[host] = [processes, threads]
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    with open(path + ".tmp", "wt") as f:
+        json.dump(tuned, f, indent=1)
+    os.replace(path + ".tmp", path)
+    return processes, threads
+
+def autotune_sample(html_file: Path, max_chars: int = 400, sentences: int = 8) -> List[str]:
+    """Returns the first few spoken chunks of a book, to time synthesis with."""
+    sample = []
+    with open(html_file, 'r', encoding='utf-8') as f:
+        for chunk in pack_chunks(iter_tts_chunks(f), max_chars):
+            if not chunk.startswith("["):
+                sample.append(chunk)
+                if len(sample) == sentences:
+                    break
+    return sample
+
+def ffmetadata_chapters(chapters: Iterable[Tuple[str, int]], title: str | None = None) -> str:
+    """Returns an ffmpeg metadata file with a chapter for each (title, samples) in order."""
+    def escape(text: str) -> str:
+        return re.sub(r"([=;#\\\n])", r"\\\1", text)
+    lines = [";FFMETADATA1"]
+    if title:
+        lines.append(f"title={escape(title)}")
+    start = 0
+    for name, samples in chapters:
+        lines += ["[CHAPTER]", f"TIMEBASE=1/{SAMPLE_RATE}", f"START={start}", f"END={start + samples}", f"title={escape(name)}"]
+        start += samples
+    return "\n".join(lines) + "\n"
+
+
+def encode_m4b(pcm_blocks: Iterable[bytes], out_path: Path, bitrate: str = '64k', metadata: str | None = None):
+    """Encode mono 16 bit PCM at SAMPLE_RATE to AAC in an MP4 container by piping it to ffmpeg.
+
+    The file is written under a temporary name and renamed when complete, so an interrupted
+    conversion never leaves an output that looks up to date.  metadata is the path of an
+    ffmpeg metadata file whose title and chapters are written to the output.
+    """
+    ffmpeg = shutil.which('ffmpeg')
+    if ffmpeg is None:
+        raise RuntimeError("ffmpeg is required for saving MP4 files.")
+    tmp_path = str(out_path) + '.tmp'
+    start = time.perf_counter()
+    proc = subprocess.Popen([ffmpeg, '-y', '-loglevel', 'error',
+                             '-f', 's16le', '-ar', str(SAMPLE_RATE), '-ac', '1', '-i', 'pipe:0',
+                             *(['-i', metadata, '-map', '0:a', '-map_metadata', '1', '-map_chapters', '1'] if metadata else []),
+                             '-c:a', 'aac', '-b:a', bitrate, '-f', 'mp4', tmp_path],
+                            stdin=subprocess.PIPE)
+    try:
+        for block in pcm_blocks:
+            proc.stdin.write(block)
+    except BrokenPipeError:
+        pass  # ffmpeg exited early; its status says why
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+        status = proc.wait()
+    if status != 0:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise RuntimeError(f"ffmpeg failed with status {status} encoding {out_path}")
+    os.replace(tmp_path, out_path)
+    metrics.observe('tts_encode_seconds', time.perf_counter() - start)
+    print(f"Saved MP4: {out_path}")
+
 def save_mp4(waveform: torch.Tensor, out_path: Path, audio_book: bool = True):
-    sr = 24000  # Kokoro sample rate
-    if AudioSegment is None:
-        raise RuntimeError("pydub is required for saving MP4 files.")
-    # Use pydub + ffmpeg    
     samples = (waveform.clamp(-1,1) * 32767).short().numpy()
-    seg = AudioSegment(
-        samples.tobytes(),
-        frame_rate=sr,
-        sample_width=2,
-        channels=1,
-
-    )
-    seg.export(str(out_path), format='mp4', bitrate='64k')
-    print(f"Saved MP4: {out_path}")
+    block = SAMPLE_RATE * 10
+    encode_m4b((samples[i:i+block].tobytes() for i in range(0, len(samples), block)), out_path)
+
+
+QUALITY_SENTENCES = [
+    "The quick brown fox jumps over the lazy dog.",
+    "Chapter 1",
+    "She paused at the door, listening for footsteps in the hall below.",
+    "\"Are you sure?\" he asked, and she laughed, because of course she wasn't.",
+    "It was nineteen eighty-four, and the rain had not stopped for three days.",
+    "The river ran quiet and slow beneath the old stone bridge.",
+]
+
+def spectrogram(audio: np.ndarray, n_fft: int = 1024, hop: int = 256) -> np.ndarray:
+    """Returns the log-magnitude spectrogram of audio, one row per frame."""
+    if len(audio) < n_fft:
+        audio = np.pad(audio, (0, n_fft - len(audio)))
+    frames = np.lib.stride_tricks.sliding_window_view(audio, n_fft)[::hop] * np.hanning(n_fft)
+    return np.log1p(np.abs(np.fft.rfft(frames, axis=1)))
+
+def spectral_similarity(reference: np.ndarray, audio: np.ndarray) -> float:
+    """Mean cosine similarity of the spectrogram frames of two renderings of the same text.
+
+    The renderings may differ a little in length, so the frames of audio are stretched onto
+    those of reference before they are compared.
+    """
+    a, b = spectrogram(reference), spectrogram(audio)
+    b = b[np.linspace(0, len(b) - 1, len(a)).round().astype(int)]
+    cosine = (a * b).sum(axis=1) / (np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1) + 1e-9)
+    return float(cosine.mean())
+
+def quality_check(voice: str, speed: float, min_similarity: float = 0.9, max_length_change: float = 0.05) -> bool:
+    """Compare the quantized model with the float32 model on QUALITY_SENTENCES.
+
+    Each sentence passes if the spectrograms are similar enough and the length of the speech
+    changed by no more than max_length_change.  The speedup of the quantized model is printed.
+
+    Returns:
+        True if every sentence passed
+    """
+    pipelines = [ load_pipeline('cpu'), load_pipeline('cpu', quantize=True) ]
+
+    def render(pipeline, text: str) -> Tuple[np.ndarray, float]:
+        start = time.perf_counter()
+        blocks = [ audio.detach().cpu().float().numpy() for _, _, audio in pipeline(text, voice=voice, speed=speed) if audio is not None ]
+        return np.concatenate(blocks), time.perf_counter() - start
+
+    for pipeline in pipelines:
+        render(pipeline, QUALITY_SENTENCES[0])  # warm up
+    passed = True
+    elapsed = [ 0.0, 0.0 ]
+    for text in QUALITY_SENTENCES:
+        (reference, t0), (audio, t1) = (render(pipeline, text) for pipeline in pipelines)
+        elapsed[0] += t0
+        elapsed[1] += t1
+        similarity = spectral_similarity(reference, audio)
+        length = len(audio) / len(reference) - 1
+        ok = similarity >= min_similarity and abs(length) <= max_length_change
+        passed = passed and ok
+        print(f"{'ok  ' if ok else 'FAIL'} similarity {similarity:.3f} length {length:+6.1%}  {text}")
+    print(f"float32 {elapsed[0]:.2f}s, int8 {elapsed[1]:.2f}s, speedup x{elapsed[0]/elapsed[1]:.2f}")
+    return passed
 
 
 def parse_args():
     p = argparse.ArgumentParser(description="Convert HTML text content to speech MP4 via Kokoro")
-    p.add_argument('html_file', type=Path, help='Input HTML file')
+    p.add_argument('html_file', type=Path, nargs='?', help='Input HTML file')
     p.add_argument('--voice', default='af_bella', help='Voice name (default: af_bella)')
     p.add_argument('--speed', type=float, default=1.0, help='Speech speed multiplier')
     p.add_argument('--device', default=None, help='Torch device (cpu, mps, cuda)')
-    p.add_argument('--max-chars', type=int, default=400, help='Max chars per synthesis chunk')
+    p.add_argument('--max-chars', type=int, default=400, help='Max chars per synthesis chunk, 0 for one sentence per chunk')
     p.add_argument('--output', type=Path, help='Explicit output mp3 path (optional)')
-    return p.parse_args()
+    p.add_argument('--jobs', type=int, default=None, help='Worker processes: books converted at once in directory mode, sections of the book otherwise (default: one per 4 cores on the CPU, one on a GPU)')
+    p.add_argument('--threads', type=int, default=None, help='torch threads per worker process (default: the cores divided between the workers)')
+    p.add_argument('--autotune', action='store_true', help='Time synthesis on this host to choose --jobs and --threads; the result is kept in the cache directory')
+    p.add_argument('--force', action='store_true', help='Convert books whose output is already up to date')
+    p.add_argument('--quantize', action='store_true', help='Faster CPU inference with the model quantized to int8 (saved in ./cache/models)')
+    p.add_argument('--quality-check', action='store_true', help='Compare the quantized model with float32 on a fixed set of sentences and exit')
+    p.add_argument('--cache-dir', default='./cache/tts', help='Sentence audio cache directory (default: ./cache/tts)')
+    p.add_argument('--cache-size', type=int, default=2048, help='Sentence audio cache size limit in MB')
+    p.add_argument('--no-cache', action='store_true', help='Synthesize every sentence, without the audio cache')
+    p.add_argument('--metrics', default=None, help="Record timings and counters: Prometheus text if the file ends in .prom, JSON lines otherwise; 'off' disables them (default: $LITERO_METRICS, or off)")
+    args = p.parse_args()
+    if args.html_file is None and not args.quality_check:
+        p.error("the html_file argument is required")
+    return args
+
+def output_path(html_file: Path, output: Path | None) -> Path:
+    if output and os.path.isdir(output):
+        return Path(output) / (html_file.stem + '.m4b')
+    return Path(output) if output else html_file.with_suffix('.m4b')
+
+def is_up_to_date(html_file: Path, out_path: Path) -> bool:
+    """True if out_path exists and is newer than the HTML it was made from."""
+    try:
+        return os.path.getmtime(out_path) >= os.path.getmtime(html_file)
+    except OSError:
+        return False
+
+def render_section(path: str, section: Section, voice: str, speed: float, device: str | None, pipeline=None, cache: AudioCache | None = None) -> Tuple[int, float]:
+    """Synthesize a section into a float32 file at path; returns its length in samples and its peak."""
+    with AudioSpool(path=path) as spool:
+        for audio in iter_audio(section.chunks, voice=voice, speed=speed, device=device, pipeline=pipeline, cache=cache, break_time=section.break_time):
+            spool.write(audio)
+        return spool.samples, spool.peak
+
+def process_html_file(html_file: Path, voice: str, speed: float, device: str | None, output: Path | None, max_chars: int = 400, pipeline: KPipeline | None = None,
+                      cache: AudioCache | None = None, jobs: int = 1, threads: int | None = None, quantize: bool = False):
+    """Converts an HTML book to an .m4b audio book with a chapter at each heading.
 
-def process_html_file(html_file: Path, voice: str, speed: float, device: str | None, output: Path | None):
+    The book is split into sections at its headings.  With one job each section is rendered
+    in this process as soon as the parser reaches its end; with more, the whole book is split
+    first and the sections are cut further into shards (see split_shards()), rendered by jobs
+    worker processes of threads torch threads each (by default the CPU cores divided between
+    them).  The rendered audio is normalized as a whole and
+    encoded in book order into a single file, with chapter markers at the section boundaries.
+    """
     if not html_file.exists():
         print(f"File not found: {html_file}", file=sys.stderr)
         sys.exit(1)
-    with open(html_file, 'r', encoding='utf-8') as f:
-        html_doc = f.read()
-    chunks = html_to_tts_chunks(html_doc)
-    if len(chunks) == 0:
-        print("No text extracted from HTML.", file=sys.stderr)
-        sys.exit(2)
-    print(f"Split into {len(chunks)} chunks")
-    waveform = synthesize(chunks, voice=voice, speed=speed, device=device)
-    if output and os.path.isdir(output):
-        out_path = os.path.join(output, html_file.stem + '.m4b')
-    else:
-        out_path = output if output else html_file.with_suffix('.m4b')
-    save_mp4(waveform, out_path)
+    out_path = output_path(html_file, output)
+    with open(html_file, 'r', encoding='utf-8') as f, \
+         tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(out_path)), prefix=".tts-") as workdir:
+        sections = split_sections(pack_chunks(iter_tts_chunks(f), max_chars))
+        if jobs > 1:
+            # shards are balanced over the whole book, so it is parsed before rendering starts
+            sections = list(sections)
+            shards = split_shards(sections, jobs)
+            jobs = min(jobs, len(shards))
+        if jobs <= 1:
+            shards, paths, shard_audio = [], [], []
+            if pipeline is None:
+                pipeline = _LazyPipeline(device, quantize)
+            for i, section in enumerate(sections):
+                shards.append((i, section))
+                paths.append(os.path.join(workdir, f"shard-{i:05d}.f32"))
+                shard_audio.append(render_section(paths[i], section, voice, speed, device, pipeline, cache))
+            sections = [ section for _, section in shards ]
+        else:
+            paths = [ os.path.join(workdir, f"shard-{i:05d}.f32") for i in range(len(shards)) ]
+            shard_audio: List[Tuple[int, float]] = [ (0, 0.0) ] * len(shards)
+            threads = threads or max(1, (os.cpu_count() or 1) // jobs)
+            print(f"Rendering {len(sections)} sections in {len(shards)} shards with {jobs} workers of {threads} threads")
+            initargs = (device, threads, cache.cache_dir if cache else None, cache.max_bytes if cache else 0, quantize)
+            # the longest shards are started first so that the workers finish together
+            order = sorted(range(len(shards)), key=lambda i: -sum(len(c) for c in shards[i][1].chunks))
+            context = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_init_worker, initargs=initargs) as pool:
+                futures = { pool.submit(_render_section, paths[i], shards[i][1], voice, speed, device): i for i in order }
+                for future in as_completed(futures):
+                    shard_audio[futures[future]] = future.result()
+        if not shards:
+            print("No text extracted from HTML.", file=sys.stderr)
+            sys.exit(2)
+        if not any(samples for samples, _ in shard_audio):
+            raise RuntimeError("No audio generated.")
+
+        # lengths of the sections, reassembled from their shards in book order
+        rendered = [ 0 ] * len(sections)
+        for (idx, _), (samples, _) in zip(shards, shard_audio):
+            rendered[idx] += samples
+
+        # a heading with nothing under it is joined to the next one, e.g. "Chapter 2, Page 1"
+        chapters = []
+        titles: List[str] = []
+        carry = 0
+        for i, (section, samples) in enumerate(zip(sections, rendered)):
+            titles.append(section.title or html_file.stem)
+            carry += samples
+            if section.heading_only and i + 1 < len(sections):
+                continue
+            chapters.append((", ".join(titles), carry))
+            titles, carry = [], 0
+        metadata = os.path.join(workdir, "chapters.txt")
+        with open(metadata, "w", encoding="utf-8") as f:
+            f.write(ffmetadata_chapters(chapters, title=html_file.stem))
+        peak = max(peak for _, peak in shard_audio)
+        scale = 0.95 / peak if peak > 0 else 1.0
+
+        def pcm():
+            for path in paths:
+                with open(path, "rb") as f:
+                    yield from pcm16_blocks(f, scale)
+        encode_m4b(pcm(), out_path, metadata=metadata)
+
+# Pipeline and audio cache of a worker process, opened once by _init_worker() and used for
+# every book or section the worker renders.
+_pipeline: _LazyPipeline | None = None
+_cache: AudioCache | None = None
+
+def _init_worker(device: str | None, threads: int, cache_dir: str | None = None, cache_bytes: int = 0, quantize: bool = False):
+    global _pipeline, _cache
+    os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
+    torch.set_num_threads(threads)
+    _pipeline = _LazyPipeline(device, quantize)
+    _cache = AudioCache(cache_dir, cache_bytes, model_version(quantize)) if cache_dir else None
+
+def _render_section(path: str, section: Section, voice: str, speed: float, device: str | None) -> Tuple[int, float]:
+    print(f"Rendering {section.title or 'opening'}...")
+    try:
+        return render_section(path, section, voice, speed, device, _pipeline, _cache)
+    finally:
+        metrics.flush()
+
+def _convert_book(html_file: Path, voice: str, speed: float, device: str | None, output: Path, max_chars: int) -> str | None:
+    """Converts one book in a worker; returns None, or the reason the book failed."""
+    print(f"Processing {html_file}...")
+    try:
+        process_html_file(html_file, voice, speed, device, output, max_chars, pipeline=_pipeline, cache=_cache)
+    except SystemExit as ex:
+        return f"exit status {ex.code}"
+    except Exception as ex:
+        return str(ex)
+    finally:
+        metrics.flush()
+    return None
+
+def default_jobs(device: str | None) -> int:
+    """Worker processes used unless --jobs is given: one per 4 cores on the CPU, but one on a GPU,
+    where every process would load its own copy of the model."""
+    if device is None:
+        device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    return max(1, (os.cpu_count() or 1) // 4) if device == 'cpu' else 1
+
+def process_directory(html_dir: Path, voice: str, speed: float, device: str | None, output: Path, max_chars: int = 400, jobs: int | None = None, force: bool = False,
+                      cache_dir: str | None = None, cache_bytes: int = 0, threads: int | None = None, quantize: bool = False) -> List[Path]:
+    """Converts every HTML book in html_dir, several at a time.
+
+    Each worker process loads the Kokoro pipeline once and converts whole books from a shared
+    queue, with the CPU cores divided between the workers for torch's intra-op threads.  Books
+    whose .m4b is newer than their HTML are skipped unless force is set.  The longest books
+    are queued first so that the workers finish at about the same time.
+
+    Args:
+        html_dir: Directory of HTML books
+        output: Directory the .m4b files are written to
+        jobs: Number of worker processes, default default_jobs(device)
+        force: Convert books even if their output is up to date
+        cache_dir: Directory of the sentence audio cache shared by the workers, None for no cache
+        cache_bytes: Size limit of the audio cache
+        threads: torch threads per worker, default the cores divided between the workers
+        quantize: Use the int8 quantized model, see load_pipeline()
+
+    Returns:
+        The books that failed
+    """
+    cores = os.cpu_count() or 1
+    if jobs is None:
+        jobs = default_jobs(device)
+    books = []
+    for html_file in html_dir.glob("*.html"):
+        if not force and is_up_to_date(html_file, output_path(html_file, output)):
+            print(f"{html_file}: up to date")
+        else:
+            books.append(html_file)
+    if not books:
+        return []
+    books.sort(key=lambda b: os.path.getsize(b), reverse=True)
+    jobs = max(1, min(jobs, len(books)))
+    threads = threads or max(1, cores // jobs)
+    print(f"Converting {len(books)} books with {jobs} workers of {threads} threads")
+
+    failed = []
+    args = (voice, speed, device, output, max_chars)
+    if jobs == 1:
+        _init_worker(device, threads, cache_dir, cache_bytes, quantize)
+        for html_file in books:
+            error = _convert_book(html_file, *args)
+            if error:
+                print(f"{html_file}: FAILED {error}", file=sys.stderr)
+                failed.append(html_file)
+        return failed
+    # torch is not fork safe once initialised, so the workers are started fresh
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context, initializer=_init_worker, initargs=(device, threads, cache_dir, cache_bytes, quantize)) as pool:
+        futures = { pool.submit(_convert_book, html_file, *args): html_file for html_file in books }
+        for future in as_completed(futures):
+            html_file = futures[future]
+            try:
+                error = future.result()
+            except Exception as ex:
+                error = str(ex)
+            if error:
+                print(f"{html_file}: FAILED {error}", file=sys.stderr)
+                failed.append(html_file)
+    return failed
 
 def main():
     os.environ['PYTORCH_ENABLE_MPS_FALLBACK'] = '1'
     args = parse_args()
+    if args.metrics is not None:
+        metrics.configure(args.metrics)
+    if args.quality_check:
+        sys.exit(0 if quality_check(args.voice, args.speed) else 1)
     output = args.output
+    cache_dir = None if args.no_cache else args.cache_dir
+    cache_bytes = args.cache_size * 1024 * 1024
+    jobs, threads = args.jobs, args.threads
+    if args.autotune:
+        books = sorted(args.html_file.glob("*.html")) if os.path.isdir(args.html_file) else [ args.html_file ]
+        if books:
+            sample = autotune_sample(books[0], args.max_chars)
+            jobs, threads = autotune(args.device, sample, args.voice, args.speed, os.path.join(args.cache_dir, "autotune.json"), args.quantize)
+            print(f"[autotune] {jobs} processes of {threads} threads")
     if os.path.isdir(args.html_file):
-        filelist = list(args.html_file.glob("*.html"))
-        for html_file in filelist:
-            print(f"Processing {html_file}...")
-            if not output:
-                output = os.path.join(os.path.dirname(args.html_file), "audio")
-                os.makedirs(output, exist_ok=True)
-            process_html_file(html_file, args.voice, args.speed, args.device, output)
+        if not output:
+            output = Path(os.path.dirname(args.html_file)) / "audio"
+        os.makedirs(output, exist_ok=True)
+        failed = process_directory(args.html_file, args.voice, args.speed, args.device, output, args.max_chars, jobs, args.force, cache_dir, cache_bytes, threads, args.quantize)
+        if failed:
+            sys.exit(1)
     else:
-        process_html_file(args.html_file, args.voice, args.speed, args.device, output)
+        cache = AudioCache(cache_dir, cache_bytes, model_version(args.quantize)) if cache_dir else None
+        jobs = jobs or default_jobs(args.device)
+        process_html_file(args.html_file, args.voice, args.speed, args.device, output, args.max_chars, cache=cache, jobs=jobs, threads=threads, quantize=args.quantize)
+    if metrics.enabled():
+        metrics.flush()
+        print(metrics.summary())
 
 if __name__ == '__main__':
     main()